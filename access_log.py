@@ -0,0 +1,81 @@
+# encoding: utf-8
+# Registro de los pedidos atendidos, escrito desde un thread aparte para que
+# las conexiones nunca esperen a la salida.
+
+import sys
+import json
+import time
+import queue
+import random
+import threading
+from constants import *
+
+# Entradas que el thread escritor junta como máximo en cada escritura.
+LOG_BATCH = 256
+
+
+class AccessLog(object):
+    """
+    Registro de accesos: una línea JSON por comando atendido, con la fecha,
+    el cliente, el comando, el código de respuesta, los bytes enviados y la
+    duración.
+
+    Las conexiones solo encolan la entrada; un thread la formatea y la
+    escribe en `output`. Se registra una fracción `sample_rate` de los
+    comandos, elegidos al azar. Si la cola de `queue_size` entradas está
+    llena, la entrada se descarta y se cuenta en `dropped`, en lugar de
+    frenar a la conexión.
+    """
+
+    def __init__(self, output=sys.stdout, sample_rate=DEFAULT_LOG_SAMPLE,
+                 queue_size=DEFAULT_LOG_QUEUE_SIZE):
+        self.output = output
+        self.sample_rate = sample_rate
+        self.entries = queue.Queue(queue_size)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        writer = threading.Thread(target=self._write_entries, daemon=True)
+        writer.start()
+
+    def log(self, peer, command, status, sent, duration):
+        """
+        Encola la entrada de un comando, si le toca según el muestreo.
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        try:
+            self.entries.put_nowait(
+                (time.time(), peer, command, status, sent, duration))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def _write_entries(self):
+        """
+        Thread escritor: escribe las entradas de a tandas.
+        """
+        while True:
+            lines = [self._format(self.entries.get())]
+            while len(lines) < LOG_BATCH:
+                try:
+                    lines.append(self._format(self.entries.get_nowait()))
+                except queue.Empty:
+                    break
+            try:
+                self.output.write(''.join(lines))
+                self.output.flush()
+            except (OSError, ValueError) as e:
+                sys.stderr.write('access log: {}\n'.format(e))
+
+    def _format(self, entry):
+        timestamp, peer, command, status, sent, duration = entry
+        return json.dumps({
+            'time': '%s.%03dZ' % (
+                time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)),
+                int(timestamp % 1 * 1000)),
+            'peer': peer,
+            'command': command,
+            'status': status,
+            'bytes': sent,
+            'duration_ms': round(duration * 1000, 3),
+        }) + '\n'
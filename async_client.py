@@ -0,0 +1,347 @@
+# encoding: utf-8
+# Cliente HFTP sobre asyncio, con un pool de conexiones compartido, para
+# manejar muchas transferencias concurrentes desde un solo thread.
+
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from binascii import a2b_base64
+from constants import *
+from client import (RECV_CHUNK, EOL_BYTES, DEFAULT_CONNECTIONS,
+                    DEFAULT_SEGMENT_SIZE)
+
+# Conexiones abiertas a la vez con cada server, como máximo.
+DEFAULT_POOL_SIZE = 8
+# Segundos que puede tardar cada pedido, incluida la espera de una conexión.
+DEFAULT_TIMEOUT = 30.0
+# Las conexiones ociosas por más de estos segundos se cierran.
+IDLE_TIMEOUT = 60.0
+
+
+class AsyncConnection(object):
+    """
+    Una conexión a un server HFTP. Lee del socket de a pedazos de
+    `RECV_CHUNK` bytes sobre un buffer propio, igual que `client.Client`,
+    para no depender del largo de las líneas.
+    """
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.connected = True
+        self.last_used = time.monotonic()
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls((host, port), reader, writer)
+
+    def healthy(self):
+        """
+        Indica si la conexión se puede reusar: el server no la cerró y no
+        quedaron datos de una respuesta sin leer.
+        """
+        return (self.connected and not self.writer.transport.is_closing()
+                and not self.reader.at_eof() and not self.buffer)
+
+    def close(self):
+        self.connected = False
+        self.writer.close()
+
+    async def send(self, message):
+        self.writer.write((message + EOL).encode("ascii"))
+        await self.writer.drain()
+
+    async def _recv(self):
+        data = await self.reader.read(RECV_CHUNK)
+        if not data:
+            logging.info("El server interrumpió la conexión.")
+            self.connected = False
+        self.buffer += data
+
+    def _consume(self, length):
+        data = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        self.scanned = 0
+        return data
+
+    async def read_line(self):
+        """
+        Como `Client.read_line`: devuelve la próxima línea sin el
+        terminador, o "" si se cortó la conexión.
+        """
+        end = self.buffer.find(EOL_BYTES, self.scanned)
+        while end == -1 and self.connected:
+            self.scanned = max(len(self.buffer) - len(EOL_BYTES) + 1, 0)
+            await self._recv()
+            end = self.buffer.find(EOL_BYTES, self.scanned)
+        if end == -1:
+            self.connected = False
+            return ""
+        return self._consume(end + len(EOL_BYTES))[:end].decode(
+            "ascii").strip()
+
+    async def read_response_line(self):
+        """
+        Devuelve el código de la respuesta, o None si es inválida.
+        """
+        response = await self.read_line()
+        if ' ' in response:
+            code, message = response.split(None, 1)
+            try:
+                return int(code)
+            except ValueError:
+                pass
+        logging.warning("Respuesta inválida: '%s'" % response)
+        return None
+
+    async def iter_base64_line(self):
+        """
+        Como `Client._iter_base64_line`: devuelve los pedazos decodificados
+        de una línea en base64 a medida que llegan.
+        """
+        while True:
+            end = self.buffer.find(EOL_BYTES, self.scanned)
+            if end != -1:
+                text = self._consume(end + len(EOL_BYTES))[:end]
+            else:
+                usable = len(self.buffer)
+                if self.buffer.endswith(EOL_BYTES[:1]):
+                    usable -= 1
+                usable -= usable % 4
+                if usable == 0:
+                    if not self.connected:
+                        return
+                    self.scanned = max(len(self.buffer) - 1, 0)
+                    await self._recv()
+                    continue
+                text = self._consume(usable)
+            data = a2b_base64(text)
+            if data:
+                yield data
+            if end != -1:
+                return
+
+
+class ConnectionPool(object):
+    """
+    Conexiones abiertas a servers HFTP, indexadas por `(host, port)`, para
+    reusarlas entre pedidos.
+
+    Con cada server hay a lo sumo `max_connections` conexiones en uso a la
+    vez: los pedidos que exceden el límite esperan a que se libere una. Las
+    conexiones liberadas quedan ociosas hasta `idle_timeout` segundos. Antes
+    de reusar una se verifica que el server no la haya cerrado.
+    """
+
+    def __init__(self, max_connections=DEFAULT_POOL_SIZE,
+                 idle_timeout=IDLE_TIMEOUT):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.idle = {}
+        self.slots = {}
+        # Conexiones abiertas con cada server, ociosas o en uso.
+        self.opened = {}
+
+    async def acquire(self, host, port):
+        """
+        Devuelve una conexión a `(host, port)`, reusando una ociosa si hay.
+        """
+        key = (host, port)
+        slots = self.slots.get(key)
+        if slots is None:
+            slots = self.slots[key] = asyncio.Semaphore(self.max_connections)
+        await slots.acquire()
+        try:
+            idle = self.idle.get(key, ())
+            now = time.monotonic()
+            while idle:
+                connection = idle.pop()
+                if (connection.healthy()
+                        and now - connection.last_used < self.idle_timeout):
+                    return connection
+                self._discard(connection)
+            connection = await AsyncConnection.open(host, port)
+            self.opened[key] = self.opened.get(key, 0) + 1
+            return connection
+        except BaseException:
+            slots.release()
+            raise
+
+    def release(self, connection, reusable=True):
+        """
+        Devuelve `connection` al pool. Si no es `reusable`, por ejemplo
+        porque se interrumpió un pedido a la mitad, la cierra.
+        """
+        if reusable and connection.healthy():
+            connection.last_used = time.monotonic()
+            self.idle.setdefault(connection.key, deque()).append(connection)
+        else:
+            self._discard(connection)
+        self.slots[connection.key].release()
+
+    def _discard(self, connection):
+        connection.close()
+        self.opened[connection.key] -= 1
+
+    async def close(self):
+        """
+        Cierra todas las conexiones ociosas.
+        """
+        for idle in self.idle.values():
+            while idle:
+                connection = idle.pop()
+                self._discard(connection)
+        # El transporte termina de cerrarse en la siguiente vuelta del loop.
+        await asyncio.sleep(0)
+
+
+class AsyncClient(object):
+    """
+    Versión asyncio de `client.Client` para el server `(host, port)`. Cada
+    pedido toma una conexión del `pool` (uno propio si no se da), así que un
+    mismo `AsyncClient` admite pedidos concurrentes.
+
+    Cada pedido falla con `asyncio.TimeoutError` si no termina en `timeout`
+    segundos. Como en `Client`, los errores del server se registran con
+    logging y el método devuelve None.
+    """
+
+    def __init__(self, host=DEFAULT_ADDR, port=DEFAULT_PORT, pool=None,
+                 timeout=DEFAULT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.timeout = timeout
+
+    async def close(self):
+        await self.pool.close()
+
+    async def _request(self, command, read_reply):
+        """
+        Envía `command` por una conexión del pool y devuelve lo que devuelva
+        `read_reply(connection, status)`.
+        """
+        return await asyncio.wait_for(self._run(command, read_reply),
+                                      self.timeout)
+
+    async def _run(self, command, read_reply):
+        connection = await self.pool.acquire(self.host, self.port)
+        reusable = False
+        try:
+            await connection.send(command)
+            status = await connection.read_response_line()
+            result = await read_reply(connection, status)
+            # Tras un error fatal el server cierra la conexión.
+            reusable = status is not None and not 100 <= status < 200
+            return result
+        finally:
+            self.pool.release(connection, reusable)
+
+    async def file_lookup(self):
+        """
+        Obtiene el listado de archivos en el server. Devuelve una lista de
+        strings.
+        """
+        async def read_reply(connection, status):
+            result = []
+            if status != CODE_OK:
+                logging.warning("Falló la solicitud de la lista de archivos "
+                                "(code=%s)." % status)
+                return result
+            filename = await connection.read_line()
+            while filename:
+                result.append(filename)
+                filename = await connection.read_line()
+            return result
+        return await self._request('get_file_listing', read_reply)
+
+    async def get_metadata(self, filename):
+        """
+        Obtiene el tamaño del archivo, o None en caso de error.
+        """
+        async def read_reply(connection, status):
+            if status == CODE_OK:
+                return int(await connection.read_line())
+        return await self._request('get_metadata %s' % filename, read_reply)
+
+    async def get_slice(self, filename, start, length):
+        """
+        Obtiene un trozo de un archivo en el server. Devuelve su contenido, o
+        None en caso de error.
+        """
+        async def read_reply(connection, status):
+            if status != CODE_OK:
+                logging.warning("El servidor indico un error al leer de %s."
+                                % filename)
+                return None
+            fragment = bytearray()
+            async for data in connection.iter_base64_line():
+                fragment += data
+            return bytes(fragment)
+        return await self._request(
+            'get_slice %s %d %d' % (filename, start, length), read_reply)
+
+    async def get_slice_at(self, filename, start, length, fd):
+        """
+        Obtiene un trozo de un archivo y lo escribe en el descriptor `fd` en
+        la posición `start`. Devuelve `True` si se escribió completo.
+        """
+        async def read_reply(connection, status):
+            if status != CODE_OK:
+                logging.warning("El servidor indico un error al leer de %s."
+                                % filename)
+                return False
+            written = 0
+            async for data in connection.iter_base64_line():
+                data = memoryview(data)
+                while len(data) > 0:
+                    count = os.pwrite(fd, data, start + written)
+                    data = data[count:]
+                    written += count
+            return written == length
+        return await self._request(
+            'get_slice %s %d %d' % (filename, start, length), read_reply)
+
+    async def retrieve(self, filename, connections=DEFAULT_CONNECTIONS,
+                       segment_size=DEFAULT_SEGMENT_SIZE):
+        """
+        Obtiene un archivo completo y lo guarda en el directorio actual con
+        el mismo nombre, bajando de a segmentos de `segment_size` bytes por
+        hasta `connections` conexiones del pool a la vez.
+
+        Devuelve `True` si el archivo se bajó completo.
+        """
+        size = await self.get_metadata(filename)
+        if size is None:
+            logging.warning("No se pudo obtener el archivo %s." % filename)
+            return False
+        segments = deque((start, min(segment_size, size - start))
+                         for start in range(0, size, segment_size))
+
+        async def fetch():
+            while segments:
+                start, length = segments.popleft()
+                if not await self.get_slice_at(filename, start, length, fd):
+                    segments.clear()
+                    return False
+            return True
+
+        fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            workers = min(connections, len(segments))
+            # Esperamos a todas antes de cerrar `fd`, aunque alguna falle.
+            results = await asyncio.gather(
+                *(fetch() for _ in range(workers)), return_exceptions=True)
+        finally:
+            os.close(fd)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return all(results)
@@ -0,0 +1,142 @@
+# encoding: utf-8
+# Hashes por bloque de archivos, para que el cliente baje solo los bloques
+# que cambiaron.
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from stat_cache import FileStat
+from constants import *
+
+
+def block_digest(data):
+    """
+    Devuelve el hash en hexadecimal de un bloque.
+    """
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def min_hash_block(size):
+    """
+    Devuelve el tamaño de bloque mínimo admitido para un archivo de `size`
+    bytes: `MIN_HASH_BLOCK`, o más si hiciera falta para no pasar de
+    `MAX_HASH_BLOCKS` bloques.
+    """
+    return max(MIN_HASH_BLOCK, -(-size // MAX_HASH_BLOCKS))
+
+
+def file_block_hashes(pread, size, block_size):
+    """
+    Calcula los hashes de los bloques de `block_size` bytes de un archivo de
+    `size` bytes, leyendo con `pread(size, offset)`. El último bloque puede
+    ser más corto.
+    """
+    hashes = []
+    for offset in range(0, size, block_size):
+        hashes.append(block_digest(pread(min(block_size, size - offset),
+                                         offset)))
+    return hashes
+
+
+class HashCache(object):
+    """
+    Cache de los hashes por bloque de los archivos servidos, indexado por
+    ruta y tamaño de bloque. Cada entrada recuerda el `FileStat` del archivo
+    hasheado y deja de valer si el archivo cambia.
+
+    Guarda a lo sumo `max_entries` entradas en memoria. Si se da
+    `index_dir`, además guarda los hashes en un archivo por entrada en ese
+    directorio, para no recalcularlos al reiniciar el servidor.
+    """
+
+    def __init__(self, max_entries, index_dir=None):
+        self.max_entries = max_entries
+        self.index_dir = index_dir
+        if index_dir is not None and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, file_info, block_size):
+        """
+        Devuelve la lista de hashes de `path` con bloques de `block_size`
+        bytes, si está guardada para la versión `file_info`, o `None`.
+        """
+        key = (os.path.abspath(path), block_size)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == file_info:
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        hashes = self._load(key, file_info)
+        if hashes is not None:
+            self._remember(key, file_info, hashes)
+        return hashes
+
+    def put(self, path, file_info, block_size, hashes):
+        """
+        Guarda los hashes de la versión `file_info` de `path`.
+        """
+        key = (os.path.abspath(path), block_size)
+        self._remember(key, file_info, hashes)
+        self._save(key, file_info, hashes)
+
+    def invalidate(self, path):
+        """
+        Descarta los hashes en memoria de `path`, o todos si es `None`. Se
+        registra como listener del `StatCache`.
+        """
+        with self.lock:
+            for key in list(self.entries):
+                if path is None or key[0] == path:
+                    del self.entries[key]
+
+    def _remember(self, key, file_info, hashes):
+        with self.lock:
+            self.entries[key] = (file_info, hashes)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _index_path(self, key):
+        path, block_size = key
+        name = hashlib.sha1(os.fsencode(path)).hexdigest()
+        return os.path.join(self.index_dir, '%s-%d.idx' % (name, block_size))
+
+    def _load(self, key, file_info):
+        """
+        Lee los hashes del índice en disco, si corresponden a `file_info`.
+        """
+        if self.index_dir is None:
+            return None
+        try:
+            with open(self._index_path(key)) as index:
+                lines = index.read().split()
+        except OSError:
+            return None
+        try:
+            header = FileStat(*(int(n) for n in lines[:len(FileStat._fields)]))
+        except (TypeError, ValueError):
+            return None
+        if header != file_info:
+            return None
+        return lines[len(FileStat._fields):]
+
+    def _save(self, key, file_info, hashes):
+        """
+        Escribe los hashes en el índice en disco, reemplazándolo de forma
+        atómica.
+        """
+        if self.index_dir is None:
+            return
+        index_path = self._index_path(key)
+        temp_path = '%s.%d.tmp' % (index_path, threading.get_ident())
+        try:
+            with open(temp_path, 'w') as index:
+                index.write(' '.join(str(n) for n in file_info) + '\n')
+                index.write('\n'.join(hashes))
+            os.replace(temp_path, index_path)
+        except OSError:
+            pass
@@ -6,13 +6,32 @@
 # Copyright 2008-2010 Natalia Bidart y Daniel Moisset
 # $Id: client.py 387 2011-03-22 13:48:44Z nicolasw $
 
+import os
+import queue
 import socket
 import logging
 import optparse
 import sys
+import threading
 import time
-from base64 import b64decode
+import zlib
+from collections import deque
+from binascii import a2b_base64
 from constants import *
+from block_hashes import file_block_hashes, min_hash_block
+
+# Bytes que se piden por vez al socket.
+RECV_CHUNK = 2 ** 16
+EOL_BYTES = EOL.encode("ascii")
+# Descarga segmentada: conexiones en paralelo y bytes de cada segmento.
+DEFAULT_CONNECTIONS = 1
+DEFAULT_SEGMENT_SIZE = 8 * 2 ** 20
+# Tamaño de bloque con que se comparan los archivos en `sync`.
+DEFAULT_SYNC_BLOCK = 2 ** 16
+# Sufijo del archivo donde se anotan los rangos ya bajados al retomar.
+JOURNAL_SUFFIX = '.hftp-journal'
+# Comandos de un pipeline enviados y sin respuesta leída, como máximo.
+DEFAULT_PIPELINE_DEPTH = 64
 
 
 class Client(object):
@@ -26,8 +45,18 @@ class Client(object):
         """
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.status = None
+        self.server = server
+        self.port = port
         self.s.connect((server, port))
-        self.buffer = ''
+        # Datos recibidos y no procesados, y hasta dónde ya buscamos EOL.
+        self.buffer = bytearray()
+        self.scanned = 0
+        # Espacio donde recibe cada recv_into.
+        self.chunk = bytearray(RECV_CHUNK)
+        self.chunk_view = memoryview(self.chunk)
+        self.cursor = None
+        # Nivel de compresión negociado con el server (0: ninguna).
+        self.compression = 0
         self.connected = True
 
     def close(self):
@@ -68,13 +97,22 @@ class Client(object):
         Para uso privado del cliente.
         """
         self.s.settimeout(timeout)
-        data = self.s.recv(4096).decode("ascii")
-        self.buffer += data
+        received = self.s.recv_into(self.chunk)
+        self.buffer += self.chunk_view[:received]
 
-        if len(data) == 0:
+        if received == 0:
             logging.info("El server interrumpió la conexión.")
             self.connected = False
 
+    def _consume(self, length):
+        """
+        Saca los primeros `length` bytes del buffer interno.
+        """
+        data = bytes(self.buffer[:length])
+        del self.buffer[:length]
+        self.scanned = 0
+        return data
+
     def read_line(self, timeout=None):
         """
         Espera datos hasta obtener una línea completa delimitada por el
@@ -83,7 +121,10 @@ class Client(object):
         Devuelve la línea, eliminando el terminaodr y los espacios en blanco
         al principio y al final.
         """
-        while not EOL in self.buffer and self.connected:
+        # Buscamos el EOL solo en lo que llegó desde la última búsqueda.
+        end = self.buffer.find(EOL_BYTES, self.scanned)
+        while end == -1 and self.connected:
+            self.scanned = max(len(self.buffer) - len(EOL_BYTES) + 1, 0)
             if timeout is not None:
                 t1 = time.process_time()
             self._recv(timeout)
@@ -91,9 +132,10 @@ class Client(object):
                 t2 = time.process_time()
                 timeout -= t2 - t1
                 t1 = t2
-        if EOL in self.buffer:
-            response, self.buffer = self.buffer.split(EOL, 1)
-            return response.strip()
+            end = self.buffer.find(EOL_BYTES, self.scanned)
+        if end != -1:
+            response = self._consume(end + len(EOL_BYTES))[:end]
+            return response.decode("ascii").strip()
         else:
             self.connected = False
             return ""
@@ -117,30 +159,153 @@ class Client(object):
             logging.warning("Respuesta inválida: '%s'" % response)
         return result
 
+    def _iter_base64_line(self):
+        """
+        Espera y decodifica una línea en base64, devolviendo los pedazos
+        decodificados a medida que llegan, sin acumular el texto. Al
+        terminar, `self.line_done` indica si se llegó al fin de la línea o
+        se cortó la conexión antes.
+        """
+        self.line_done = False
+        while True:
+            end = self.buffer.find(EOL_BYTES, self.scanned)
+            if end != -1:
+                # Decodificamos lo que queda de la línea.
+                text = self._consume(end + len(EOL_BYTES))[:end]
+            else:
+                # Decodificamos los grupos de 4 caracteres completos. Un
+                # '\r' al final puede ser el comienzo del EOL.
+                usable = len(self.buffer)
+                if self.buffer.endswith(EOL_BYTES[:1]):
+                    usable -= 1
+                usable -= usable % 4
+                if usable == 0:
+                    if not self.connected:
+                        return
+                    self.scanned = max(len(self.buffer) - 1, 0)
+                    self._recv()
+                    continue
+                text = self._consume(usable)
+
+            data = a2b_base64(text)
+            if data:
+                yield data
+            if end != -1:
+                self.line_done = True
+                return
+
+    def _iter_fragment(self, length):
+        """
+        Espera y decodifica un fragmento de `length` bytes de un archivo,
+        devolviendo los pedazos decodificados a medida que llegan. Si se
+        negoció compresión y el server comprimió el fragmento, lo
+        descomprime.
+        """
+        encoding = COMPRESSION_IDENTITY
+        if self.compression > 0:
+            encoding = self.read_line()
+
+        if encoding == COMPRESSION_ZLIB:
+            decompressor = zlib.decompressobj()
+            for data in self._iter_base64_line():
+                data = decompressor.decompress(data)
+                if data:
+                    yield data
+            data = decompressor.flush()
+            if data:
+                yield data
+            return
+
+        # El fragmento termina con el fin de la línea en que se completa.
+        remaining = length
+        while True:
+            for data in self._iter_base64_line():
+                remaining -= len(data)
+                yield data
+            if not self.line_done or remaining <= 0:
+                return
+
     def read_fragment(self, length):
         """
         Espera y lee un fragmento de un archivo.
 
         Devuelve el contenido del fragmento.
         """
-        # Ahora, esperamos hasta tener la cantidad de datos necesaria
-        data = self.read_line()
-        fragment = b64decode(data)
-        while len(fragment) < length:
-            data = self.read_line()
-            fragment += b64decode(data)
-
+        # Decodificamos directamente en un buffer del tamaño final.
+        fragment = bytearray(length)
+        view = memoryview(fragment)
+        received = 0
+        for data in self._iter_fragment(length):
+            data = data[:length - received]
+            view[received:received + len(data)] = data
+            received += len(data)
+
+        if received < length:
+            return fragment[:received]
         return fragment
 
-    def file_lookup(self):
+    def read_raw(self, length, output):
+        """
+        Espera y lee exactamente `length` bytes sin codificar, escribiéndolos
+        en el archivo `output` a medida que llegan.
+
+        Devuelve la cantidad de bytes leídos, que es menor a `length` solo
+        si el server cortó la conexión.
+        """
+        data = self._consume(length)
+        output.write(data)
+        received = len(data)
+        self.s.settimeout(None)
+        while received < length and self.connected:
+            size = self.s.recv_into(self.chunk, min(length - received,
+                                                    len(self.chunk)))
+            if size == 0:
+                logging.info("El server interrumpió la conexión.")
+                self.connected = False
+            output.write(self.chunk_view[:size])
+            received += size
+
+        return received
+
+    def set_compression(self, level):
+        """
+        Negocia con el server que comprima los fragmentos de get_slice con
+        zlib al nivel `level` (0 para no comprimir). La descompresión es
+        transparente para los demás métodos.
+        """
+        self.send('set_compression %d' % level)
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            self.compression = level
+        else:
+            logging.warning("El server no aceptó la compresión (code=%s %s)."
+                            % (self.status, message))
+
+    def file_lookup(self, limit=None, cursor=LISTING_START):
         """
         Obtener el listado de archivos en el server. Devuelve una lista
         de strings.
+
+        Si se da `limit`, pide solo una página de a lo sumo `limit` archivos
+        a partir de `cursor`, y deja en `self.cursor` el cursor para pedir
+        la página siguiente (`LISTING_END` si no quedan más).
+        """
+        if limit is None:
+            self.send('get_file_listing')
+        else:
+            self.send('get_file_listing_page %s %d' % (cursor, limit))
+        return self._read_listing(limit is not None)
+
+    def _read_listing(self, paged):
+        """
+        Lee la respuesta de get_file_listing, o de get_file_listing_page si
+        `paged`.
         """
         result = []
-        self.send('get_file_listing')
         self.status, message = self.read_response_line()
         if self.status == CODE_OK:
+            if paged:
+                self.cursor = self.read_line()
             filename = self.read_line()
             while filename:
                 logging.debug("Received filename %s" % filename)
@@ -152,43 +317,377 @@ class Client(object):
 
         return result
 
+    def file_lookup_pages(self, limit):
+        """
+        Recorre el listado de archivos del server de a páginas de a lo sumo
+        `limit` archivos. Devuelve un iterador de listas de strings.
+        """
+        cursor = LISTING_START
+        while True:
+            page = self.file_lookup(limit, cursor)
+            if self.status != CODE_OK:
+                return
+            if page:
+                yield page
+            if self.cursor == LISTING_END:
+                return
+            cursor = self.cursor
+
     def get_metadata(self, filename):
         """
         Obtiene en el server el tamaño del archivo con el nombre dado.
         Devuelve None en caso de error.
         """
         self.send('get_metadata %s' % filename)
+        return self._read_metadata()
+
+    def _read_metadata(self):
+        """
+        Lee la respuesta de get_metadata.
+        """
         self.status, message = self.read_response_line()
         if self.status == CODE_OK:
             size = int(self.read_line())
             return size
 
+    def get_block_hashes(self, filename, block_size):
+        """
+        Obtiene del server los hashes de los bloques de `block_size` bytes
+        del archivo. Devuelve una lista de strings, o None en caso de error.
+        """
+        self.send('get_block_hashes %s %d' % (filename, block_size))
+        return self._read_block_hashes()
+
+    def _read_block_hashes(self):
+        """
+        Lee la respuesta de get_block_hashes.
+        """
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            return None
+        hashes = []
+        digest = self.read_line()
+        while digest:
+            hashes.append(digest)
+            digest = self.read_line()
+        return hashes
+
+    def get_stats(self):
+        """
+        Obtiene las métricas del server. Devuelve un diccionario de nombre a
+        valor numérico, o None en caso de error.
+        """
+        self.send('get_stats')
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            return None
+        stats = {}
+        line = self.read_line()
+        while line:
+            name, value = line.split()
+            try:
+                stats[name] = int(value)
+            except ValueError:
+                stats[name] = float(value)
+            line = self.read_line()
+        return stats
+
+    def sync(self, filename, block_size=DEFAULT_SYNC_BLOCK):
+        """
+        Actualiza la copia local del archivo para que sea igual a la del
+        server, bajando solo los bloques cuyo hash difiere. Si el archivo es
+        tan grande que `block_size` daría demasiados bloques, se usa el
+        mínimo que admite el server.
+
+        Devuelve la cantidad de bytes pedidos al server, o None en caso de
+        error.
+        """
+        # Pedimos el tamaño y los hashes juntos, en un solo viaje.
+        pipeline = self.pipeline()
+        metadata = pipeline.get_metadata(filename)
+        hashes = pipeline.get_block_hashes(filename, block_size)
+        size = metadata.result()
+        remote = hashes.result()
+        if metadata.status != CODE_OK:
+            logging.warning("No se pudo obtener el archivo %s (code=%s)."
+                            % (filename, metadata.status))
+            return None
+        status = hashes.status
+        if status == INVALID_ARGUMENTS and block_size < min_hash_block(size):
+            # Demasiados bloques: pedimos de nuevo con bloques más grandes.
+            block_size = min_hash_block(size)
+            remote = self.get_block_hashes(filename, block_size)
+            status = self.status
+        if status != CODE_OK:
+            logging.warning("No se pudieron obtener los hashes de %s "
+                            "(code=%s)." % (filename, status))
+            return None
+
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            local_size = os.fstat(fd).st_size
+            local = file_block_hashes(
+                lambda length, offset: os.pread(fd, length, offset),
+                local_size, block_size)
+            os.ftruncate(fd, size)
+
+            # Juntamos los bloques distintos consecutivos en un solo rango.
+            ranges = []
+            for i, digest in enumerate(remote):
+                if i < len(local) and local[i] == digest:
+                    continue
+                start = i * block_size
+                length = min(block_size, size - start)
+                if ranges and ranges[-1][0] + ranges[-1][1] == start:
+                    ranges[-1][1] += length
+                else:
+                    ranges.append([start, length])
+
+            fetched = 0
+            for start, length in ranges:
+                if not self.get_slice_at(filename, start, length, fd):
+                    return None
+                fetched += length
+        finally:
+            os.close(fd)
+
+        return fetched
+
     def get_slice(self, filename, start, length):
         """
         Obtiene un trozo de un archivo en el server.
 
         El archivo es guardado localmente, en el directorio actual, con el
-        mismo nombre que tiene en el server.
+        mismo nombre que tiene en el server. El trozo se escribe a medida
+        que llega, sin tenerlo entero en memoria.
         """
         self.send('get_slice %s %d %d' % (filename, start, length))
         self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            with open(filename, 'wb') as output:
+                self.write_fragment(length, output.fileno(), 0)
+        else:
+            logging.warning("El servidor indico un error al leer de %s."
+                            % filename)
+
+    def write_fragment(self, length, fd, position):
+        """
+        Espera un fragmento de `length` bytes de un archivo y lo escribe en
+        el descriptor `fd` a partir de `position` a medida que se decodifica.
+
+        Devuelve la cantidad de bytes escritos, que es menor a `length` solo
+        si el server cortó la conexión.
+        """
+        written = 0
+        for data in self._iter_fragment(length):
+            data = memoryview(data)[:length - written]
+            while len(data) > 0:
+                count = os.pwrite(fd, data, position + written)
+                data = data[count:]
+                written += count
+        return written
+
+    def get_slices(self, filename, ranges):
+        """
+        Obtiene varios trozos de un archivo en el server con un solo pedido.
+        `ranges` es una lista de pares `(start, length)`.
+
+        Devuelve una lista con el contenido de cada trozo, en el mismo
+        orden, o None en caso de error.
+        """
+        ranges_text = ",".join("%d:%d" % (start, length)
+                               for start, length in ranges)
+        self.send('get_slices %s %s' % (filename, ranges_text))
+        return self._read_slices(filename, len(ranges))
+
+    def _read_slices(self, filename, count):
+        """
+        Lee la respuesta de get_slices con `count` rangos.
+        """
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            logging.warning("El servidor indico un error al leer de %s."
+                            % filename)
+            return None
+        fragments = []
+        for _ in range(count):
+            fragments.append(b"".join(self._iter_base64_line()))
+        return fragments
+
+    def _read_slice(self, filename, length):
+        """
+        Lee la respuesta de get_slice y devuelve el contenido del trozo, o
+        None en caso de error.
+        """
+        self.status, message = self.read_response_line()
+        if self.status != CODE_OK:
+            logging.warning("El servidor indico un error al leer de %s."
+                            % filename)
+            return None
+        return bytes(self.read_fragment(length))
+
+    def pipeline(self, max_in_flight=DEFAULT_PIPELINE_DEPTH):
+        """
+        Devuelve un `Pipeline` para mandar varios comandos por esta conexión
+        sin esperar la respuesta de cada uno.
+        """
+        return Pipeline(self, max_in_flight)
+
+    def get_slice_raw(self, filename, start, length):
+        """
+        Como `get_slice`, pero pide el trozo sin codificar en base64, así que
+        se transfieren exactamente `length` bytes.
+        """
+        self.send('get_slice_raw %s %d %d' % (filename, start, length))
+        self.status, message = self.read_response_line()
         if self.status == CODE_OK:
             output = open(filename, 'wb')
-            fragment = self.read_fragment(length)
-            output.write(fragment)
+            received = self.read_raw(length, output)
             output.close()
+            if received < length:
+                logging.warning("Se recibieron %d de %d bytes de %s."
+                                % (received, length, filename))
         else:
             logging.warning("El servidor indico un error al leer de %s."
                             % filename)
 
-    def retrieve(self, filename):
+    def get_slice_at(self, filename, start, length, fd):
+        """
+        Obtiene un trozo de un archivo en el server y lo escribe en el
+        descriptor `fd` en la misma posición `start` que tiene en el server,
+        a medida que llega.
+
+        Devuelve `True` si se escribió el trozo completo.
+        """
+        self.send('get_slice %s %d %d' % (filename, start, length))
+        self.status, message = self.read_response_line()
+        if self.status == CODE_OK:
+            return self.write_fragment(length, fd, start) == length
+        logging.warning("El servidor indico un error al leer de %s."
+                        % filename)
+        return False
+
+    def _fetch_segments(self, filename, fd, segments, errors, journal):
+        """
+        Baja por esta conexión segmentos de la cola hasta que se vacíe o
+        haya un error, anotando en `journal` los que se completan.
+        """
+        try:
+            while not errors:
+                try:
+                    start, length = segments.get_nowait()
+                except queue.Empty:
+                    break
+                if not self.get_slice_at(filename, start, length, fd):
+                    if self.status == CODE_OK:
+                        errors.append("conexión interrumpida")
+                    else:
+                        errors.append(self.status)
+                elif journal is not None:
+                    journal.record(start, length, fd)
+        except (socket.error, ValueError) as e:
+            errors.append(e)
+
+    def _segment_worker(self, filename, fd, segments, errors, journal):
+        """
+        Thread de la descarga segmentada: abre su propia conexión y baja
+        segmentos por ella.
+        """
+        try:
+            client = Client(self.server, self.port)
+        except socket.error as e:
+            errors.append(e)
+            return
+        try:
+            client._fetch_segments(filename, fd, segments, errors, journal)
+        finally:
+            if client.connected:
+                try:
+                    client.close()
+                except socket.error:
+                    pass
+
+    def retrieve_segmented(self, filename, size, connections, segment_size,
+                           resume=False):
+        """
+        Obtiene un archivo de `size` bytes bajando segmentos de a lo sumo
+        `segment_size` bytes por `connections` conexiones en paralelo. Cada
+        segmento se escribe en su posición de un archivo del tamaño final.
+
+        Con `resume`, los segmentos completos se anotan en un journal al
+        lado del archivo, y si la descarga se interrumpe, el próximo intento
+        pide solo los rangos que faltan.
+        """
+        journal = None
+        if resume:
+            journal = DownloadJournal(filename, size)
+            ranges = journal.missing()
+        else:
+            ranges = [(0, size)]
+
+        segments = queue.Queue()
+        for range_start, range_length in ranges:
+            range_end = range_start + range_length
+            for start in range(range_start, range_end, segment_size):
+                segments.put((start, min(segment_size, range_end - start)))
+
+        flags = os.O_WRONLY | os.O_CREAT
+        if journal is None or not journal.done:
+            flags |= os.O_TRUNC
+        fd = os.open(filename, flags, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            if size > 0 and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    pass  # El sistema de archivos no lo soporta.
+
+            errors = []
+            if connections == 1:
+                self._fetch_segments(filename, fd, segments, errors, journal)
+            else:
+                workers = []
+                for _ in range(min(connections, segments.qsize())):
+                    worker = threading.Thread(
+                        target=self._segment_worker,
+                        args=(filename, fd, segments, errors, journal))
+                    worker.start()
+                    workers.append(worker)
+                for worker in workers:
+                    worker.join()
+        finally:
+            os.close(fd)
+
+        if errors:
+            logging.warning("Falló la descarga segmentada de %s (%s)."
+                            % (filename, errors[0]))
+            if isinstance(errors[0], int):
+                self.status = errors[0]
+            else:
+                self.status = INTERNAL_ERROR
+            if journal is not None:
+                journal.close()
+        elif journal is not None:
+            journal.finish()
+
+    def retrieve(self, filename, connections=DEFAULT_CONNECTIONS,
+                 segment_size=DEFAULT_SEGMENT_SIZE, resume=False):
         """
         Obtiene un archivo completo desde el servidor.
+
+        Con más de una conexión, los archivos de más de `segment_size` bytes
+        se bajan de a segmentos en paralelo. Con `resume`, la descarga se
+        puede retomar donde quedó si se interrumpe.
         """
         size = self.get_metadata(filename)
         if self.status == CODE_OK:
             assert size >= 0
-            self.get_slice(filename, 0, size)
+            if resume or (connections > 1 and size > segment_size):
+                self.retrieve_segmented(filename, size, connections,
+                                        segment_size, resume)
+            else:
+                self.get_slice(filename, 0, size)
         elif self.status == FILE_NOT_FOUND:
             logging.info("El archivo solicitado no existe.")
         else:
@@ -196,6 +695,219 @@ class Client(object):
                             % (filename, self.status))
 
 
+class PipelineResult(object):
+    """
+    Resultado de un comando encolado en un `Pipeline`. Cuando se leyó su
+    respuesta, `done` es verdadero y `status` y `value` tienen el código y
+    lo que habría devuelto el método bloqueante del `Client`.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.done = False
+        self.status = None
+        self.value = None
+
+    def result(self):
+        """
+        Espera la respuesta del comando, leyendo antes las de los comandos
+        anteriores, y devuelve su valor.
+        """
+        while not self.done:
+            self.pipeline.read_next()
+        return self.value
+
+
+class Pipeline(object):
+    """
+    Manda varios comandos por la conexión de un `Client` sin esperar la
+    respuesta de cada uno, y lee las respuestas en orden.
+
+    Los métodos encolan el comando y devuelven un `PipelineResult`. Los
+    comandos encolados se envían juntos, de una sola escritura, al pedir un
+    resultado, al iterar o al llamar a `flush`. Nunca hay más de
+    `max_in_flight` comandos enviados sin respuesta leída, para no llenar
+    los buffers de la conexión.
+
+    Ejemplo:
+        with client.pipeline() as pipeline:
+            sizes = [pipeline.get_metadata(name) for name in names]
+        for name, size in zip(names, sizes):
+            print(name, size.value)
+    """
+
+    def __init__(self, client, max_in_flight=DEFAULT_PIPELINE_DEPTH):
+        assert max_in_flight > 0
+        self.client = client
+        self.max_in_flight = max_in_flight
+        # Comandos encolados y no enviados: (comando, resultado, lector).
+        self.queued = deque()
+        # Comandos enviados y sin respuesta: (resultado, lector).
+        self.in_flight = deque()
+        # Resultados que todavía no devolvió la iteración.
+        self.unread = deque()
+
+    def file_lookup(self, limit=None, cursor=LISTING_START):
+        if limit is None:
+            command = 'get_file_listing'
+        else:
+            command = 'get_file_listing_page %s %d' % (cursor, limit)
+        return self._queue(command, self.client._read_listing,
+                           limit is not None)
+
+    def get_metadata(self, filename):
+        return self._queue('get_metadata %s' % filename,
+                           self.client._read_metadata)
+
+    def get_block_hashes(self, filename, block_size):
+        return self._queue('get_block_hashes %s %d' % (filename, block_size),
+                           self.client._read_block_hashes)
+
+    def get_slice(self, filename, start, length):
+        """
+        A diferencia de `Client.get_slice`, el valor es el contenido del
+        trozo en lugar de guardarlo en un archivo.
+        """
+        return self._queue('get_slice %s %d %d' % (filename, start, length),
+                           self.client._read_slice, filename, length)
+
+    def get_slices(self, filename, ranges):
+        ranges_text = ",".join("%d:%d" % (start, length)
+                               for start, length in ranges)
+        return self._queue('get_slices %s %s' % (filename, ranges_text),
+                           self.client._read_slices, filename, len(ranges))
+
+    def _queue(self, command, reader, *args):
+        result = PipelineResult(self)
+        self.queued.append((command, result, lambda: reader(*args)))
+        self.unread.append(result)
+        return result
+
+    def flush(self):
+        """
+        Envía, en una sola escritura, todos los comandos encolados que
+        entren sin pasar de `max_in_flight` comandos sin respuesta.
+        """
+        batch = []
+        while self.queued and (len(self.in_flight) + len(batch)
+                               < self.max_in_flight):
+            command, result, reader = self.queued.popleft()
+            self.in_flight.append((result, reader))
+            batch.append(command)
+        if batch:
+            self.client.send(EOL.join(batch))
+
+    def read_next(self):
+        """
+        Lee la respuesta del comando enviado más antiguo y envía más
+        comandos encolados si hay lugar.
+        """
+        self.flush()
+        result, reader = self.in_flight.popleft()
+        result.value = reader()
+        result.status = self.client.status
+        result.done = True
+        self.flush()
+        return result
+
+    def __iter__(self):
+        """
+        Devuelve, en orden, los resultados de los comandos encolados,
+        esperando la respuesta de cada uno.
+        """
+        while self.unread:
+            result = self.unread.popleft()
+            result.result()
+            yield result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # Si hubo una excepción, las respuestas pendientes no se leen.
+        if exc[0] is None:
+            for result in self:
+                pass
+
+
+class DownloadJournal(object):
+    """
+    Registro de los rangos ya bajados de un archivo, guardado en un archivo
+    al lado de la descarga. La primera línea es el tamaño del archivo en el
+    server y cada una de las siguientes un rango completo `inicio fin`.
+
+    Si el tamaño anotado no coincide con el actual, el archivo cambió en el
+    server y se empieza de nuevo.
+    """
+
+    def __init__(self, filename, size):
+        self.path = filename + JOURNAL_SUFFIX
+        self.size = size
+        self.done = self._load()
+        self.lock = threading.Lock()
+        if self.done:
+            self.file = open(self.path, 'a')
+        else:
+            self.file = open(self.path, 'w')
+            self.file.write('%d\n' % size)
+            self.file.flush()
+
+    def _load(self):
+        """
+        Devuelve los rangos `(inicio, fin)` anotados en el journal, o una
+        lista vacía si no hay journal válido para este tamaño.
+        """
+        try:
+            with open(self.path) as journal:
+                lines = journal.read().splitlines()
+        except FileNotFoundError:
+            return []
+        try:
+            if not lines or int(lines[0]) != self.size:
+                return []
+            # Una última línea incompleta se descarta.
+            return [tuple(int(n) for n in line.split())
+                    for line in lines[1:] if len(line.split()) == 2]
+        except ValueError:
+            return []
+
+    def missing(self):
+        """
+        Devuelve la lista de rangos `(inicio, largo)` que faltan bajar.
+        """
+        ranges = []
+        position = 0
+        for start, end in sorted(self.done):
+            if start > position:
+                ranges.append((position, start - position))
+            position = max(position, end)
+        if position < self.size:
+            ranges.append((position, self.size - position))
+        return ranges
+
+    def record(self, start, length, fd):
+        """
+        Anota como completo el rango de `length` bytes desde `start`, luego
+        de asegurar que sus datos llegaron al disco en `fd`.
+        """
+        os.fsync(fd)
+        with self.lock:
+            self.done.append((start, start + length))
+            self.file.write('%d %d\n' % (start, start + length))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    def finish(self):
+        """
+        La descarga terminó: borra el journal.
+        """
+        self.file.close()
+        os.remove(self.path)
+
+
 def main():
     """
     Interfaz interactiva simple para el cliente: permite elegir un archivo
@@ -215,6 +927,15 @@ def main():
                       help="Determina cuanta informacion de depuracion a mostrar"
                       "(valores posibles son: ERROR, WARN, INFO, DEBUG)",
                       default="ERROR")
+    parser.add_option("-c", "--connections", type="int",
+                      help="Cantidad de conexiones en paralelo para bajar "
+                      "el archivo", default=DEFAULT_CONNECTIONS)
+    parser.add_option("-s", "--segment-size", type="int",
+                      help="Bytes de cada segmento al bajar con varias "
+                      "conexiones", default=DEFAULT_SEGMENT_SIZE)
+    parser.add_option("-r", "--resume", action="store_true",
+                      help="Retomar una descarga interrumpida, bajando solo "
+                      "lo que falta", default=False)
     options, args = parser.parse_args()
     try:
         port = int(options.port)
@@ -224,7 +945,8 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    if len(args) != 1 or options.level not in list(DEBUG_LEVELS.keys()):
+    if (len(args) != 1 or options.level not in list(DEBUG_LEVELS.keys())
+            or options.connections < 1 or options.segment_size < 1):
         parser.print_help()
         sys.exit(1)
 
@@ -249,7 +971,8 @@ def main():
 
     if client.status == CODE_OK:
         print("* Indique el nombre del archivo a descargar:")
-        client.retrieve(input().strip())
+        client.retrieve(input().strip(), options.connections,
+                        options.segment_size, options.resume)
 
     client.close()
 
@@ -0,0 +1,63 @@
+# encoding: utf-8
+# Decisión de comprimir o no los slices cuando el cliente negoció
+# compresión.
+
+import zlib
+import threading
+from collections import OrderedDict
+
+# Bytes del slice que se comprimen de prueba para estimar si conviene.
+COMPRESS_SAMPLE = 2 ** 16
+# Slices más chicos que esto se envían sin comprimir.
+MIN_COMPRESS_SIZE = 512
+# Si la muestra comprimida ocupa más que esta fracción del original, el
+# archivo se considera incompresible.
+MAX_COMPRESS_RATIO = 0.9
+# Archivos de los que se recuerda la relación de compresión.
+RATIO_CACHE_SIZE = 4096
+
+
+class RatioCache(object):
+    """
+    Recuerda la relación de compresión estimada de cada versión de archivo
+    (su `FileStat`), para no volver a tomar muestras en cada slice.
+    """
+
+    def __init__(self, max_entries=RATIO_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, file_info):
+        with self.lock:
+            ratio = self.entries.get(file_info)
+            if ratio is not None:
+                self.entries.move_to_end(file_info)
+            return ratio
+
+    def put(self, file_info, ratio):
+        with self.lock:
+            self.entries[file_info] = ratio
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+ratios = RatioCache()
+
+
+def worth_compressing(file, file_info, offset, size):
+    """
+    Decide si conviene comprimir `size` bytes del `OpenFile` `file` desde
+    `offset`. Si no se conoce la relación de compresión del archivo, la
+    estima comprimiendo rápido una muestra del comienzo del slice.
+    """
+    if size < MIN_COMPRESS_SIZE:
+        return False
+    ratio = ratios.get(file_info)
+    if ratio is None:
+        sample = file.pread(min(size, COMPRESS_SAMPLE), offset)
+        if not sample:
+            return False
+        ratio = len(zlib.compress(sample, 1)) / len(sample)
+        ratios.put(file_info, ratio)
+    return ratio <= MAX_COMPRESS_RATIO
@@ -5,10 +5,169 @@
 
 import sys
 import os
+import zlib
+import time
+import select
+import socket
+import bisect
+import itertools
+from collections import deque
 from constants import *
 from base64 import b64encode
+from stat_cache import file_stat
+from fd_pool import open_file
+from block_hashes import block_digest, min_hash_block
+from compression import worth_compressing
+from metrics import Metrics
+from rate_limit import RATE_CHUNK, SMALL_RESPONSE
+from readahead import AccessPattern
+from listing import ListingSnapshot, listable
 
 TAM_COMAND = 4096
+# Bytes del archivo que se codifican y envían por vez en get_slice. Es
+# múltiplo de 3 para que base64 no agregue relleno entre pedazos y la
+# concatenación sea idéntica a codificar todo el slice de una vez.
+SLICE_CHUNK = 3 * 2 ** 16
+# Bytes que se piden por llamada a sendfile en get_slice_raw.
+SENDFILE_CHUNK = 2 ** 20
+# Huecos entre rangos de get_slices de hasta estos bytes se leen igual, para
+# leer los rangos de los costados con un solo `preadv`.
+READ_GAP = 2 ** 16
+# Nombres de archivo que se envían por vez en get_file_listing.
+LISTING_CHUNK = 1024
+# Escrituras más chicas que esto se juntan con las vecinas (ver `coalesce`).
+MIN_WRITE = 2 ** 12
+# Bytes del archivo que se hashean entre cada envío de get_block_hashes.
+HASH_CHUNK = 2 ** 20
+# Máximo de nombres por página de get_file_listing_page.
+MAX_LISTING_PAGE = 10000
+# Bytes que una conexión del loop de eventos envía como máximo cada vez que
+# le toca, para que una transferencia grande no demore a las demás.
+WRITE_QUANTUM = 2 ** 18
+
+
+def coalesce(chunks):
+    """
+    Junta los pedazos de bytes del iterable `chunks` en bloques de al menos
+    `MIN_WRITE` bytes, y el resto final con el último bloque. Así una
+    respuesta no empieza ni termina con una escritura chica separada (la
+    línea de estado, el `EOL` final), que con el algoritmo de Nagle y el
+    ACK demorado del cliente puede tardar decenas de milisegundos en salir.
+    """
+    # Se retiene un bloque armado hasta saber si le sigue otro, para poder
+    # pegarle el resto final.
+    ready = None
+    pending = []
+    size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        size += len(chunk)
+        if size >= MIN_WRITE:
+            if ready is not None:
+                yield ready
+            ready = b"".join(pending)
+            pending = []
+            size = 0
+    if ready is None:
+        ready = b""
+    ready = b"".join([ready] + pending) if pending else ready
+    if ready:
+        yield ready
+
+
+class CommandParser(object):
+    r"""
+    Separa en comandos los bytes que llegan de un cliente.
+
+    Los datos se acumulan en un único `bytearray` y el `EOL` se busca solo
+    en la parte que todavía no se revisó, así que recibir un comando largo
+    de a pedazos cuesta tiempo lineal. Lo que sigue al último `EOL` se
+    conserva para la próxima vez, de modo que un cliente puede mandar
+    muchos comandos seguidos sin esperar las respuestas.
+    """
+
+    def __init__(self, max_length=MAX_COMMAND_LENGTH):
+        self.buffer = bytearray()
+        # Posición desde la que hay que seguir buscando el EOL.
+        self.scanned = 0
+        self.max_length = max_length
+        # Cuándo llegó el primer byte del comando empezado, o `None`.
+        self.started = None
+
+    def feed(self, data):
+        """
+        Agrega bytes recibidos del cliente.
+        """
+        if not self.buffer and data:
+            self.started = time.monotonic()
+        self.buffer += data
+
+    def pending(self):
+        """
+        Indica si hay un comando empezado al que le falta el resto.
+        """
+        return len(self.buffer) > 0
+
+    def commands(self):
+        r"""
+        Devuelve los comandos completos recibidos hasta ahora, sin el `EOL`.
+
+        Lanza `ValueError` si un comando no es ASCII o si el comando
+        incompleto que está llegando supera `max_length` bytes.
+
+        Ejemplo:
+        - Si se recibió `b"comando1 arg1\r\ncomando2 arg1\r\ncoman"`, devuelve
+        `["comando1 arg1", "comando2 arg1"]` y se queda con `b"coman"`.
+        """
+        eol = EOL.encode("ascii")
+        comands = []
+        start = 0
+        end = self.buffer.find(eol, self.scanned)
+        while end != -1:
+            comands.append(self.buffer[start:end].decode("ascii"))
+            start = end + len(eol)
+            end = self.buffer.find(eol, start)
+
+        del self.buffer[:start]
+        if not self.buffer:
+            self.started = None
+        elif comands:
+            # Lo que sigue al último comando completo es uno nuevo.
+            self.started = time.monotonic()
+        # El último byte podría ser el comienzo de un EOL partido en dos.
+        self.scanned = max(len(self.buffer) - len(eol) + 1, 0)
+
+        if not comands and len(self.buffer) > self.max_length:
+            raise ValueError("command too long")
+
+        return comands
+
+
+class FileRegion(object):
+    """
+    Parte de un archivo abierto pendiente de enviar con sendfile.
+    """
+
+    def __init__(self, file, offset, size):
+        self.file = file
+        self.offset = offset
+        self.size = size
+
+    def close(self):
+        self.file.close()
+
+
+class PendingLog(object):
+    """
+    Entrada del registro de accesos que espera en la cola de salida a que
+    se termine de enviar la respuesta del comando.
+    """
+
+    def __init__(self, comand, status, start, sent):
+        self.comand = comand
+        self.status = status
+        self.start = start
+        self.sent = sent
 
 
 class Connection(object):
@@ -18,23 +177,77 @@ class Connection(object):
     que termina la conexión.
     """
 
-    def __init__(self, socket, directory):
+    def __init__(self, socket, directory, stat_cache=None, slice_cache=None,
+                 fd_pool=None, hash_cache=None, metrics=None,
+                 access_log=None, idle_timeout=0, read_timeout=0,
+                 write_timeout=0, throttle=None, slice_flights=None,
+                 shared_slice_size=0, readahead=None, listing=None):
         # Guardamos el socket y el directorio.
         self.socket = socket
         self.directory = directory
+        # Cache de metadatos compartido con las demás conexiones, si hay.
+        self.stat_cache = stat_cache
+        # Cache de respuestas de get_slice ya codificadas, si hay.
+        self.slice_cache = slice_cache
+        # Pool de archivos abiertos compartido, si hay.
+        self.fd_pool = fd_pool
+        # Cache de hashes por bloque compartido, si hay.
+        self.hash_cache = hash_cache
+        # Métricas compartidas del servidor, o unas propias si no hay.
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.add('connections_total')
+        # Registro de accesos compartido, si hay.
+        self.access_log = access_log
+        # Plazos en segundos para que la conexión avance (0: sin límite).
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        # Lecturas de get_slice en curso compartidas con las demás
+        # conexiones (`singleflight.SingleFlight`), si hay, y hasta qué
+        # tamaño de slice se comparten.
+        self.slice_flights = slice_flights
+        self.shared_slice_size = shared_slice_size
+        # Recorrido de los slices pedidos, para leer por adelantado con el
+        # `readahead.ReadAhead` compartido, si hay.
+        self.access_pattern = None
+        if readahead is not None:
+            self.access_pattern = AccessPattern(readahead)
+        # Límites de ancho de banda de la conexión (`rate_limit.Throttle`),
+        # si hay.
+        self.throttle = throttle
+        # Listado ordenado del directorio para get_file_listing_page,
+        # compartido con las demás conexiones si hay.
+        self.listing = listing
+        if listing is None:
+            self.listing = ListingSnapshot(directory)
+        # Bytes enviados por esta conexión, y código de la última respuesta.
+        self.bytes_sent = 0
+        self.status = None
+        # Nivel de compresión zlib negociado para get_slice (0: ninguna).
+        self.compression = 0
         # Indicamos que la conexión está activa.
         self.connected = True
+        # Separa los comandos que llegan por el socket.
+        self.parser = CommandParser()
         # Diccionario que mapea los comandos a sus respectivos métodos.
         self.COMMAND_HANDLERS = {
             "get_file_listing": (0, self._get_file_listing),
+            "get_file_listing_page": (2, self._get_file_listing_page),
             "get_metadata": (1, self._get_metadata),
             "get_slice": (3, self._get_slice),
+            "get_slice_raw": (3, self._get_slice_raw),
+            "get_slices": (2, self._get_slices),
+            "get_block_hashes": (2, self._get_block_hashes),
+            "set_compression": (1, self._set_compression),
+            "get_stats": (0, self._get_stats),
             "quit": (0, self._quit)
         }
 
-        # Imprimimos la dirección del cliente.
-        local_address = self.socket.getsockname()
-        sys.stdout.write('Conected by: %s \n' % str(local_address))
+        # Dirección del cliente, para el registro de accesos.
+        try:
+            self.peer = '%s:%d' % self.socket.getpeername()[:2]
+        except OSError:
+            self.peer = '-'
 
     def handle(self):
         """
@@ -52,10 +265,18 @@ class Connection(object):
                     break
                 # Ejecutamos los comandos.
                 self._run_comand(comands)
+        except socket.timeout:
+            # El cliente no avanzó en el plazo: liberamos la conexión.
+            self.metrics.add('connections_reaped')
+            self.connected = False
         finally:
-            sys.stdout.write(
-                'Closing connection...\n')
             self.socket.close()
+            if self.throttle is not None:
+                self.throttle.close()
+            if self.access_pattern is not None:
+                self.access_pattern.close()
+            self.metrics.add('connections_closed')
+            self.metrics.retire_thread()
 
     def _receive_command(self):
         r"""
@@ -63,41 +284,51 @@ class Connection(object):
 
         Output:
         - Una lista de cadenas de texto que representan los comandos separados por `EOL`.
+        Si el cliente cerró la conexión, una lista vacía.
 
         Ejemplo:
         - Si el cliente envía `"comando1 arg1 arg2\r\ncomando2 arg1 arg2\r\n"`, el
         output es `["comando1 arg1 arg2", "comando2 arg1 arg2", ...]`.
         """
-
-        buffer = ""
-
-        # Guardamos los comandos en buffer hasta que encontramos un EOL o se corto la conexión.
-        while EOL not in buffer and self.connected:
+        # Recibimos datos hasta tener al menos un comando completo. Lo que
+        # llegue después del último EOL queda en el parser para la próxima.
+        while self.connected:
             try:
-
-                data = self.socket.recv(TAM_COMAND).decode("ascii")
-                buffer += data
-
-                # Obs: recv() retorna "" si se corta la conexión desde el cliente.
-                if data == "":
-                    break
-            except UnicodeError:
+                comands_text = self.parser.commands()
+            except ValueError:
+                # Comando que no es ASCII o demasiado largo.
                 self._create_message_and_send(BAD_REQUEST)
                 self.connected = False
+                break
+            if comands_text:
+                return comands_text
 
-        # Si NO encontramos un EOL en el buffer, cortamos la conexión.
-        if EOL not in buffer:
-            self.connected = False
-            return []
-        else:  # Si lo encontramos, dividimos el buffer en comandos.
-            buffer_split = buffer.split(EOL)
+            # Con un comando empezado, el resto tiene que llegar a tiempo,
+            # contando desde su primer byte: recibirlo de a poco no alarga
+            # el plazo. Sin plazo de lectura, vale el de inactividad.
+            if self.parser.pending() and self.read_timeout:
+                remaining = (self.parser.started + self.read_timeout
+                             - time.monotonic())
+                if remaining <= 0:
+                    raise socket.timeout("read timed out")
+                self._set_timeout(remaining)
+            else:
+                self._set_timeout(self.idle_timeout)
+            data = self.socket.recv(TAM_COMAND)
+            # Obs: recv() retorna b"" si se corta la conexión desde el cliente.
+            if not data:
+                self.connected = False
+                break
+            self.parser.feed(data)
 
-            if buffer_split[-1] == "":
-                # Removemos el ultimo porque siempre hay un EOL al final
-                # y split() nos devuelve "" al ultimo.
-                buffer_split.pop()
+        return []
 
-            return buffer_split
+    def _set_timeout(self, seconds):
+        """
+        Hace que las operaciones del socket lancen `socket.timeout` si no
+        avanzan en `seconds` segundos (0: sin límite).
+        """
+        self.socket.settimeout(seconds or None)
 
     def _analyze_comand(self, commands_text):
         """
@@ -113,9 +344,6 @@ class Connection(object):
         - Input: `["comando1 arg1 arg2", "comando2 arg1 arg2"]`
         - Output: `[("comando1", ["arg1", "arg2"]), ("comando2", ["arg1", "arg2"])]`
         """
-        # Imprimimos los comandos recibidos separados por " | ".
-        sys.stdout.write(f'Request: {" | ".join(commands_text)}\n')
-
         # Recorremos los comandos.
         comands = []
         for comand in commands_text:
@@ -150,12 +378,16 @@ class Connection(object):
 
         # Recorrer los comandos
         for (comand, arg) in comands:
+            start = time.perf_counter()
+            sent = self.bytes_sent
             # Verificar si el comando está definido en el diccionario
             if comand in self.COMMAND_HANDLERS:
                 (num_args, func) = self.COMMAND_HANDLERS[comand]
                 if len(arg) == num_args:
-                    # Ejecutamos el comando.
+                    # Ejecutamos el comando, midiendo cuánto tarda.
                     func(*arg)
+                    self.metrics.observe(comand, time.perf_counter() - start)
+                    self._log_command(comand, start, sent)
 
                     # Si hacemos quit no seguimos ejecutando comandos.
                     if comand == "quit":
@@ -163,17 +395,31 @@ class Connection(object):
                 else:
                     # Si la cantidad de argumentos no es la correcta.
                     self._create_message_and_send(INVALID_ARGUMENTS)
+                    self._log_command(comand, start, sent)
                     break
             else:
                 # Si el comando no está definido.
                 self._create_message_and_send(INVALID_COMMAND)
+                self._log_command(comand, start, sent)
                 break
 
+    def _log_command(self, comand, start, sent):
+        """
+        Registra en el registro de accesos un comando que empezó a
+        atenderse en `start`, cuando se habían enviado `sent` bytes.
+        """
+        if self.access_log is not None:
+            self.access_log.log(self.peer, comand, self.status,
+                                self.bytes_sent - sent,
+                                time.perf_counter() - start)
+
     def _get_file_listing(self):
         """
         Busca obtener la lista de archivos que están actualmente disponibles.
         El servidor responde con una secuencia de líneas terminadas en \r\n, cada una con el nombre de uno de los archivos disponible. 
         Una línea sin texto indica el fin de la lista.
+        Los nombres que no se pueden enviar (no ASCII, o con fines de línea)
+        se omiten.
 
         Ejemplo: 
         Comando:   get_file_listing
@@ -182,19 +428,76 @@ class Connection(object):
                    archivo2.jpg\r\n
                    \r\n
         """
-        # Recuperamos los archivos en el directorio en una lista.
-        if os.path.exists(self.directory):
-            files_in_directory = os.listdir(self.directory)
-        else:
-            files_in_directory = []
+        # Enviamos la lista de a pedazos a medida que recorremos el
+        # directorio, sin armarla entera en memoria.
+        self._create_message_and_stream(CODE_OK, self._list_files())
 
-        # Creamos el mensaje de respuesta.
-        message = self._create_message(CODE_OK)
-        for file in files_in_directory:
-            message += file + EOL
-        message += EOL
+    def _list_files(self):
+        """
+        Generador que recorre el directorio y devuelve los nombres de a
+        `LISTING_CHUNK`, ya codificados como líneas de la respuesta. Al final
+        devuelve la línea vacía que termina la lista.
+        """
+        names = []
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if not listable(entry.name):
+                        continue
+                    names.append(entry.name + EOL)
+                    if len(names) == LISTING_CHUNK:
+                        yield "".join(names).encode("ascii")
+                        names = []
+        except FileNotFoundError:
+            pass
+        names.append(EOL)
+        yield "".join(names).encode("ascii")
 
-        # Enviamos el mensaje al cliente.
+    def _get_file_listing_page(self, cursor, limit):
+        """
+        Variante paginada de get_file_listing: devuelve a lo sumo LIMIT
+        archivos, en orden alfabético, a partir de CURSOR. La primera línea
+        luego del estado es el cursor para pedir la página siguiente, o
+        `LISTING_END` si no quedan más archivos. El primer pedido usa
+        `LISTING_START` como cursor, y pedir con `LISTING_END` devuelve una
+        página vacía.
+
+        Ejemplo:
+        Comando:   get_file_listing_page - 2
+        Respuesta: 0 OK\r\n
+                   6172636869766f322e6a7067\r\n
+                   archivo1.txt\r\n
+                   archivo2.jpg\r\n
+                   \r\n
+        """
+        if not limit.isdigit() or int(limit) == 0:
+            self._create_message_and_send(INVALID_ARGUMENTS)
+            return
+        limit = min(int(limit), MAX_LISTING_PAGE)
+
+        # El cursor es el último nombre de la página anterior, en hexa.
+        after = None
+        if cursor == LISTING_END:
+            self._send_message(self._create_message(CODE_OK)
+                               + EOL.join([LISTING_END, ""]) + EOL)
+            return
+        if cursor != LISTING_START:
+            try:
+                after = os.fsdecode(bytes.fromhex(cursor))
+            except ValueError:
+                self._create_message_and_send(INVALID_ARGUMENTS)
+                return
+
+        # Las páginas salen del listado ordenado del directorio, que se
+        # vuelve a armar solo cuando el directorio cambia.
+        names, more = self.listing.page(after, limit)
+
+        next_cursor = LISTING_END
+        if more:
+            next_cursor = os.fsencode(names[-1]).hex()
+
+        lines = [next_cursor] + names + [""]
+        message = self._create_message(CODE_OK) + EOL.join(lines) + EOL
         self._send_message(message)
 
     def _get_metadata(self, filename):
@@ -212,8 +515,9 @@ class Connection(object):
 
         message = self._create_message(CODE_OK)
         # Si el archivo existe, devolvemos su tamaño.
-        if os.path.isfile(file_path):
-            file_size = str(os.path.getsize(file_path))
+        file_info = self._stat(file_path)
+        if file_info is not None:
+            file_size = str(file_info.size)
             message += file_size + EOL
         else:  # Sino, devolvemos un error.
             message = self._create_message(FILE_NOT_FOUND)
@@ -233,44 +537,462 @@ class Connection(object):
         Respuesta: 0 OK\r\n
                    Y2Fsb3IgcXVlIGhhY2UgaG95LCA=\r\n2
         """
+        slice = self._check_slice(filename, offset, size)
+        if slice is None:
+            return
+        file_path, file_info, offset, size = slice
+        self._read_ahead(file_path, file_info, offset, size)
+
+        if ((self.slice_cache is not None
+                and size <= self.slice_cache.max_entry_size)
+                or (self.slice_flights is not None
+                    and size <= self.shared_slice_size)):
+            self._send_cached_slice(file_path, file_info, offset, size)
+            return
+
+        file = self._open_file(file_path, file_info)
+        if file is None:
+            return
+
+        # Enviamos el slice codificado de a pedazos, sin tenerlo entero
+        # en memoria.
+        self._create_message_and_stream(
+            CODE_OK, self._slice_payload(file, file_info, offset, size))
+
+    def _send_cached_slice(self, file_path, file_info, offset, size):
+        """
+        Envía la respuesta de get_slice armada entera en memoria: desde el
+        cache de slices si estaba, o compartiendo la lectura con los pedidos
+        iguales de otras conexiones que estén en curso. Lo que se arma se
+        guarda en el cache, si entra.
+        """
+        key = (file_info, offset, size, self.compression)
+        cacheable = (self.slice_cache is not None
+                     and size <= self.slice_cache.max_entry_size)
+        message = self.slice_cache.get(key) if cacheable else None
+        if message is not None:
+            self._record_status(CODE_OK)
+            self._send_bytes(message)
+            return
+
+        file = self._open_file(file_path, file_info)
+        if file is None:
+            return
+        with file:
+            if self.slice_flights is None:
+                message = self._build_slice(file_path, file, file_info,
+                                            key, cacheable)
+                shared = False
+            else:
+                message, shared = self.slice_flights.do(
+                    key, lambda: self._build_slice(file_path, file,
+                                                   file_info, key, cacheable))
+        if shared:
+            # Otra conexión leyó y codificó el slice por nosotros.
+            self._record_status(CODE_OK)
+            self.metrics.add('slices_shared')
+        self._send_bytes(message)
+
+    def _build_slice(self, file_path, file, file_info, key, cacheable):
+        """
+        Arma la respuesta completa de get_slice para `key` leyendo `file`, y
+        la guarda en el cache de slices si `cacheable`.
+        """
+        offset, size = key[1], key[2]
+        chunks = [self._create_message(CODE_OK).encode("ascii")]
+        chunks.extend(self._slice_payload(file, file_info, offset, size))
+        message = b"".join(chunks)
+        if cacheable:
+            self.slice_cache.put(os.path.abspath(file_path), key, message)
+        return message
+
+    def _get_slice_raw(self, filename, offset, size):
+        """
+        Igual que get_slice, pero el fragmento se envía sin codificar: luego
+        de la línea de estado vienen exactamente SIZE bytes crudos, sin \r\n
+        al final. Los bytes se copian del archivo al socket con sendfile.
+
+        Ejemplo:
+        Comando:   get_slice_raw ejemplo1.txt 5 20
+        Respuesta: 0 OK\r\n
+                   calor que hace hoy, 
+        """
+        slice = self._check_slice(filename, offset, size)
+        if slice is None:
+            return
+        file_path, file_info, offset, size = slice
+        self._read_ahead(file_path, file_info, offset, size)
+
+        file = self._open_file(file_path, file_info)
+        if file is None:
+            return
+
+        self._create_message_and_send(CODE_OK)
+        self._send_file(file, offset, size)
+
+    def _get_slices(self, filename, ranges):
+        """
+        Este comando pide varios slices de un mismo archivo en un solo
+        pedido. RANGES es una lista separada por comas de rangos
+        `OFFSET:SIZE`. El servidor responde con un fragmento en base64 por
+        rango, cada uno en su línea y en el orden pedido, sin comprimir.
+        Si algún rango es inválido, no responde ninguno.
+
+        Ejemplo:
+        Comando:   get_slices ejemplo1.txt 5:5,0:4
+        Respuesta: 0 OK\r\n
+                   Y2Fsb3I=\r\n
+                   IVF1ZQ==\r\n
+        """
+        # Parseamos los rangos.
+        items = ranges.split(",")
+        if len(items) > MAX_BATCH_RANGES:
+            self._create_message_and_send(INVALID_ARGUMENTS)
+            return
+        requested = []
+        for item in items:
+            offset, _, size = item.partition(":")
+            if not offset.isdigit() or not size.isdigit():
+                self._create_message_and_send(INVALID_ARGUMENTS)
+                return
+            requested.append((int(offset), int(size)))
+
+        # Lo pedido se responde entero en memoria: acotamos su total, además
+        # de lo que se lee del archivo.
+        if sum(size for offset, size in requested) > MAX_BATCH_BYTES:
+            self._create_message_and_send(INVALID_ARGUMENTS)
+            return
+
+        # Validamos todos los rangos contra una sola consulta del archivo.
+        file_path = os.path.join(self.directory, filename)
+        file_info = self._stat(file_path)
+        if file_info is None:
+            self._create_message_and_send(FILE_NOT_FOUND)
+            return
+        if any(offset + size > file_info.size for offset, size in requested):
+            self._create_message_and_send(BAD_OFFSET)
+            return
+
+        # Juntamos los rangos que se superponen o son contiguos, para leer
+        # cada parte del archivo una sola vez.
+        extents = []
+        for offset, size in sorted(requested):
+            if extents and offset <= extents[-1][1]:
+                extents[-1][1] = max(extents[-1][1], offset + size)
+            else:
+                extents.append([offset, offset + size])
+        if sum(end - start for start, end in extents) > MAX_BATCH_BYTES:
+            self._create_message_and_send(INVALID_ARGUMENTS)
+            return
+
+        file = self._open_file(file_path, file_info)
+        if file is None:
+            return
+        buffers = [bytearray(end - start) for start, end in extents]
+        with file:
+            for offset, iovecs in self._read_runs(extents, buffers):
+                read = file.preadv_into(iovecs, offset)
+                self.metrics.add('disk_bytes_read', read)
+
+        self._create_message_and_stream(
+            CODE_OK, self._encode_ranges(requested, extents, buffers))
+
+    def _read_runs(self, extents, buffers):
+        """
+        Agrupa las partes del archivo a leer en tramos que se leen con un
+        solo `preadv`: partes separadas por huecos de hasta `READ_GAP` bytes
+        van en el mismo tramo, y los huecos se leen en un buffer que se
+        descarta. Devuelve una lista de pares `(offset, buffers)`.
+        """
+        gap = memoryview(bytearray(READ_GAP))
+        runs = []
+        end = None
+        for (start, extent_end), buffer in zip(extents, buffers):
+            if end is not None and start - end <= READ_GAP:
+                runs[-1][1].extend([gap[:start - end], buffer])
+            else:
+                runs.append((start, [buffer]))
+            end = extent_end
+        return runs
+
+    def _encode_ranges(self, requested, extents, buffers):
+        """
+        Generador que devuelve, en el orden pedido, cada rango codificado en
+        base64 de a `SLICE_CHUNK` bytes y terminado en `EOL`, tomándolo del
+        buffer leído de la parte del archivo que lo contiene.
+        """
+        starts = [start for start, end in extents]
+        for offset, size in requested:
+            i = bisect.bisect_right(starts, offset) - 1
+            view = memoryview(buffers[i])
+            begin = offset - extents[i][0]
+            for chunk in range(begin, begin + size, SLICE_CHUNK):
+                yield b64encode(view[chunk:min(chunk + SLICE_CHUNK,
+                                               begin + size)])
+            yield EOL.encode("ascii")
+
+    def _get_block_hashes(self, filename, block_size):
+        """
+        Este comando divide el archivo FILENAME en bloques de BLOCK_SIZE bytes
+        (el último puede ser más corto) y responde con el hash de cada
+        bloque en hexadecimal, uno por línea. Una línea sin texto indica el
+        fin de la lista. Sirve para que el cliente baje solo los bloques que
+        difieren de su copia. En archivos grandes, BLOCK_SIZE tiene que ser
+        suficiente para que no haya más de `MAX_HASH_BLOCKS` bloques.
+
+        Ejemplo:
+        Comando:   get_block_hashes ejemplo1.txt 4096
+        Respuesta: 0 OK\r\n
+                   8e5b4cb4d42e2b2c02c3f1bba1b8f5c7\r\n
+                   1f0c9c33bcd5b3a0c5a1f4a5e0f3e2d1\r\n
+                   \r\n
+        """
+        if not block_size.isdigit():
+            self._create_message_and_send(INVALID_ARGUMENTS)
+            return
+        block_size = int(block_size)
+        if not MIN_HASH_BLOCK <= block_size <= MAX_HASH_BLOCK:
+            self._create_message_and_send(INVALID_ARGUMENTS)
+            return
+
+        file_path = os.path.join(self.directory, filename)
+        file_info = self._stat(file_path)
+        if file_info is None:
+            self._create_message_and_send(FILE_NOT_FOUND)
+            return
+        if block_size < min_hash_block(file_info.size):
+            self._create_message_and_send(INVALID_ARGUMENTS)
+            return
+
+        hashes = None
+        if self.hash_cache is not None:
+            hashes = self.hash_cache.get(file_path, file_info, block_size)
+        if hashes is not None:
+            self._create_message_and_stream(CODE_OK, self._hash_lines(hashes))
+            return
+
+        file = self._open_file(file_path, file_info)
+        if file is None:
+            return
+        self._create_message_and_stream(
+            CODE_OK, self._compute_hash_lines(file_path, file, file_info,
+                                              block_size))
+
+    def _hash_lines(self, hashes):
+        """
+        Generador que devuelve una lista de hashes ya calculados como líneas
+        de la respuesta, de a `LISTING_CHUNK`, y al final la línea vacía que
+        la termina.
+        """
+        for start in range(0, len(hashes), LISTING_CHUNK):
+            lines = hashes[start:start + LISTING_CHUNK]
+            yield (EOL.join(lines) + EOL).encode("ascii")
+        yield EOL.encode("ascii")
+
+    def _compute_hash_lines(self, file_path, file, file_info, block_size):
+        """
+        Generador que hashea los bloques de `file` a medida que se envían,
+        leyendo unos `HASH_CHUNK` bytes por vez, y devuelve las líneas de la
+        respuesta. Al terminar guarda los hashes en el cache y cierra el
+        archivo.
+        """
+        hashes = []
+        lines = []
+        hashed = 0
+        with file:
+            for offset in range(0, file_info.size, block_size):
+                block = file.pread(min(block_size, file_info.size - offset),
+                                   offset)
+                self.metrics.add('disk_bytes_read', len(block))
+                digest = block_digest(block)
+                hashes.append(digest)
+                lines.append(digest + EOL)
+                hashed += len(block)
+                if hashed >= HASH_CHUNK:
+                    yield "".join(lines).encode("ascii")
+                    lines = []
+                    hashed = 0
+        lines.append(EOL)
+        yield "".join(lines).encode("ascii")
+        if self.hash_cache is not None:
+            self.hash_cache.put(file_path, file_info, block_size, hashes)
+
+    def _check_slice(self, filename, offset, size):
+        """
+        Valida los argumentos de un pedido de slice.
+
+        Output:
+        - La tupla `(file_path, file_info, offset, size)` con la ruta y el
+        `FileStat` del archivo y los argumentos convertidos a enteros, o
+        `None` si hubo un error, en cuyo caso ya se le respondió al cliente.
+        """
         # Buscamos el archivo en el directorio.
         file_path = os.path.join(self.directory, str(filename))
 
         # Verificamos que los argumentos sean enteros.
         if not offset.isdigit() or not size.isdigit():
             self._create_message_and_send(INVALID_ARGUMENTS)
-            return
+            return None
 
         offset = int(offset)
         size = int(size)
 
         # Verificamos que el archivo exista.
-        if not os.path.isfile(file_path):
+        file_info = self._stat(file_path)
+        if file_info is None:
             self._create_message_and_send(FILE_NOT_FOUND)
-            return
+            return None
 
         # Verificamos que el offset y el size sean validos.
-        file_size = os.path.getsize(file_path)
+        file_size = file_info.size
         if offset < 0 or size < 0:
             self._create_message_and_send(INVALID_ARGUMENTS)
-            return
+            return None
         elif offset + size > file_size:
             self._create_message_and_send(BAD_OFFSET)
+            return None
+
+        return file_path, file_info, offset, size
+
+    def _read_ahead(self, file_path, file_info, offset, size):
+        """
+        Anota el pedido de un slice y, si la conexión recorre el archivo en
+        orden, pide por adelantado lo que sigue.
+        """
+        if self.access_pattern is not None:
+            requested = self.access_pattern.access(file_path, file_info,
+                                                   offset, size)
+            if requested > 0:
+                self.metrics.add('readahead_bytes', requested)
+
+    def _open_file(self, file_path, file_info):
+        """
+        Abre el archivo a enviar como un `OpenFile`, tomándolo del pool de
+        archivos abiertos si hay. Se hace antes de responder OK, por si el
+        archivo desapareció: en ese caso responde FILE_NOT_FOUND y devuelve
+        `None`.
+        """
+        try:
+            if self.fd_pool is not None:
+                return self.fd_pool.open(file_path, file_info)
+            return open_file(file_path)
+        except OSError:
+            self._create_message_and_send(FILE_NOT_FOUND)
+            return None
+
+    def _set_compression(self, level):
+        """
+        Este comando negocia la compresión de las respuestas de get_slice en
+        esta conexión. LEVEL es un nivel de compresión de zlib entre 1 y 9, o
+        0 para no comprimir.
+
+        Con compresión negociada, la respuesta de get_slice lleva luego de la
+        línea de estado una línea con la codificación del fragmento: `zlib`
+        si el fragmento se comprimió antes de codificarlo en base64, o
+        `identity` si no se comprimió porque no valía la pena.
+
+        Ejemplo:
+        Comando:   set_compression 6
+        Respuesta: 0 OK\r\n
+        Comando:   get_slice ejemplo1.txt 0 4096
+        Respuesta: 0 OK\r\n
+                   zlib\r\n
+                   eJztwTEBAAAAwqD1T20ND6AAAAAAAAAAAAA...\r\n
+        """
+        if not level.isdigit() or int(level) > MAX_COMPRESSION_LEVEL:
+            self._create_message_and_send(INVALID_ARGUMENTS)
             return
+        self.compression = int(level)
+        self._create_message_and_send(CODE_OK)
+
+    def _slice_payload(self, file, file_info, offset, size):
+        """
+        Devuelve un iterador con lo que sigue a la línea de estado en la
+        respuesta de get_slice: la codificación del fragmento, si se negoció
+        compresión, y el fragmento en base64 terminado en `EOL`.
+        """
+        if self.compression == 0:
+            return self._encode_slice(file, offset, size)
+
+        if worth_compressing(file, file_info, offset, size):
+            encoding = COMPRESSION_ZLIB
+            payload = self._compress_slice(file, offset, size)
         else:
-            message = self._create_message(CODE_OK)
-            # Leemos el archivo desde el offset hasta el size.
-            with open(file_path, 'rb') as file:
-                file.seek(offset)
-                slice = file.read(size)
+            encoding = COMPRESSION_IDENTITY
+            payload = self._encode_slice(file, offset, size)
+        return itertools.chain([(encoding + EOL).encode("ascii")], payload)
 
-            # Codificamos el slice en base64.
-            encoded_slice = b64encode(slice).decode('ascii')
+    def _compress_slice(self, file, offset, size):
+        """
+        Como `_encode_slice`, pero comprime el fragmento con zlib a medida
+        que lo lee, y codifica en base64 el resultado comprimido.
+        """
+        compressor = zlib.compressobj(self.compression)
+        # Bytes comprimidos que esperan completar un múltiplo de 3.
+        pending = b""
+        with file:
+            while size > 0:
+                chunk = file.pread(min(size, SLICE_CHUNK), offset)
+                if not chunk:
+                    break
+                self.metrics.add('disk_bytes_read', len(chunk))
+                offset += len(chunk)
+                size -= len(chunk)
+                pending += compressor.compress(chunk)
+                ready = len(pending) - len(pending) % 3
+                if ready > 0:
+                    yield b64encode(pending[:ready])
+                    pending = pending[ready:]
+        pending += compressor.flush()
+        yield b64encode(pending) + EOL.encode("ascii")
 
-            message += encoded_slice + EOL
+    def _encode_slice(self, file, offset, size):
+        """
+        Generador que lee `size` bytes del `OpenFile` `file` desde `offset`
+        de a `SLICE_CHUNK` bytes y devuelve cada pedazo codificado en base64.
+        Al final devuelve el `EOL` de la respuesta y cierra el archivo.
+        """
+        with file:
+            while size > 0:
+                chunk = file.pread(min(size, SLICE_CHUNK), offset)
+                if not chunk:
+                    break
+                self.metrics.add('disk_bytes_read', len(chunk))
+                offset += len(chunk)
+                size -= len(chunk)
+                yield b64encode(chunk)
+        yield EOL.encode("ascii")
 
-            # Enviamos el mensaje al cliente.
-            self._send_message(message)
+    def _get_stats(self):
+        """
+        Este comando devuelve las métricas del servidor, una por línea como
+        `NOMBRE VALOR`: conexiones, bytes enviados y leídos de disco,
+        respuestas por código, cantidad y latencia de cada comando, y el
+        estado de los caches. Una línea sin texto indica el fin de la lista.
+
+        Ejemplo:
+        Comando:   get_stats
+        Respuesta: 0 OK\r\n
+                   uptime_seconds 12.5\r\n
+                   connections_active 1\r\n
+                   ...
+                   command_get_metadata_count 3\r\n
+                   \r\n
+        """
+        message = self._create_message(CODE_OK)
+        stats = self.metrics.snapshot()
+        lines = ['%s %s' % stat for stat in stats]
+        message += EOL.join(lines + [""]) + EOL
+        self._send_message(message)
+
+    def _stat(self, file_path):
+        """
+        Devuelve el `FileStat` de `file_path`, o `None` si no es un archivo.
+        Si hay cache de metadatos lo consulta ahí.
+        """
+        if self.stat_cache is not None:
+            return self.stat_cache.stat(file_path)
+        return file_stat(file_path)
 
     def _quit(self):
         """
@@ -288,13 +1010,115 @@ class Connection(object):
         Input:
         - `code`: Un código de respuesta de `error_messages` en `./constants.py`.
         """
+        self._record_status(code)
         return '{} {} {}'.format(code, error_messages[code], EOL)
 
+    def _record_status(self, code):
+        """
+        Anota el código de una respuesta en las métricas y para el registro
+        de accesos.
+        """
+        self.status = code
+        self.metrics.status(code)
+
     def _send_message(self, message):
         """
         Envía un mensaje al cliente en formato ASCII.
         """
-        self.socket.sendall(message.encode("ascii"))
+        self._send_bytes(message.encode("ascii"))
+
+    def _send_bytes(self, data):
+        """
+        Envía bytes al cliente. Cada `send` tiene que avanzar dentro del
+        plazo de escritura, a diferencia de `sendall`, cuyo plazo es para
+        el envío completo.
+        """
+        self._set_timeout(self.write_timeout)
+        view = memoryview(data)
+        # Con límite de ancho de banda, enviamos de a pedazos y esperamos
+        # antes de cada uno; las respuestas chicas no esperan.
+        limited = self.throttle is not None and len(view) > SMALL_RESPONSE
+        while len(view) > 0:
+            if limited:
+                self._wait_throttle()
+                sent = self.socket.send(view[:RATE_CHUNK])
+            else:
+                sent = self.socket.send(view)
+            self._count_sent(sent)
+            view = view[sent:]
+
+    def _count_sent(self, size):
+        self.bytes_sent += size
+        self.metrics.add('bytes_sent', size)
+        if self.throttle is not None:
+            self.throttle.charge(size)
+
+    def _wait_throttle(self):
+        """
+        Espera hasta que los límites de ancho de banda permitan enviar.
+        """
+        delay = self.throttle.delay()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _send_chunks(self, chunks):
+        """
+        Envía al cliente, en orden, los pedazos de bytes que produce el
+        iterable `chunks` a medida que se generan.
+        """
+        for chunk in chunks:
+            self._send_bytes(chunk)
+
+    def _send_file(self, file, offset, size):
+        """
+        Envía al cliente `size` bytes de `file` desde `offset` con
+        `os.sendfile`, sin copiarlos a memoria del proceso, y cierra el
+        archivo.
+        """
+        self._set_timeout(self.write_timeout)
+        chunk = SENDFILE_CHUNK
+        limited = self.throttle is not None and size > SMALL_RESPONSE
+        if limited:
+            chunk = RATE_CHUNK
+        with file:
+            while size > 0:
+                if limited:
+                    self._wait_throttle()
+                try:
+                    sent = os.sendfile(self.socket.fileno(), file.fileno(),
+                                       offset, min(size, chunk))
+                except BlockingIOError:
+                    # Con plazo, el socket no bloquea: esperamos a que
+                    # acepte más datos.
+                    self._wait_writable()
+                    continue
+                if sent == 0:
+                    # El archivo se achicó: ya no podemos cumplir con los
+                    # bytes prometidos, así que cortamos la conexión.
+                    self.connected = False
+                    break
+                self._count_sent(sent)
+                self.metrics.add('disk_bytes_read', sent)
+                offset += sent
+                size -= sent
+
+    def _wait_writable(self):
+        """
+        Espera a que el socket acepte datos, o lanza `socket.timeout` si no
+        lo hace dentro del plazo de escritura.
+        """
+        poller = select.poll()
+        poller.register(self.socket, select.POLLOUT)
+        if not poller.poll(self.write_timeout * 1000):
+            raise socket.timeout("write timed out")
+
+    def _create_message_and_stream(self, code, chunks):
+        """
+        Envía la línea de estado con el código `code` seguida de los pedazos
+        del iterable `chunks`, juntando las escrituras chicas.
+        """
+        message = self._create_message(code).encode("ascii")
+        self._send_chunks(coalesce(itertools.chain([message], chunks)))
 
     def _create_message_and_send(self, code):
         r"""
@@ -308,3 +1132,282 @@ class Connection(object):
         """
         message = self._create_message(code)
         self._send_message(message)
+
+
+class EventConnection(Connection):
+    """
+    Conexión atendida por el loop de eventos de `EventServer`.
+
+    Reutiliza los comandos de `Connection`, pero el socket es no bloqueante:
+    en vez de quedarse esperando en `recv` y `sendall`, el servidor llama a
+    `on_readable` y `on_writable` cuando el socket está listo, y las
+    respuestas se encolan hasta que se puedan enviar.
+    """
+
+    def __init__(self, socket, directory, **kwargs):
+        super().__init__(socket, directory, **kwargs)
+        self.socket.setblocking(False)
+        # Cola de respuestas pendientes de enviar: bytes o iteradores que
+        # producen los bytes a medida que se pueden enviar.
+        self.output = deque()
+        self.output_size = 0
+        self.streams = 0
+        # Última vez que se recibieron y enviaron datos.
+        self.last_read = self.last_write = time.monotonic()
+        # Hasta cuándo los límites de ancho de banda no nos dejan enviar.
+        self.throttled_until = 0.0
+
+    def on_readable(self):
+        """
+        Lee lo disponible en el socket y ejecuta los comandos completos.
+        """
+        try:
+            data = self.socket.recv(TAM_COMAND)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._abort()
+            return
+
+        # Obs: recv() retorna b"" si se corta la conexión desde el cliente.
+        if not data:
+            self.connected = False
+            return
+
+        self.last_read = time.monotonic()
+        self.parser.feed(data)
+        try:
+            comands_text = self.parser.commands()
+        except ValueError:
+            self._create_message_and_send(BAD_REQUEST)
+            self.connected = False
+            return
+
+        if not comands_text:
+            return
+
+        comands = self._analyze_comand(comands_text)
+        if self.connected:
+            self._run_comand(comands)
+
+    def on_writable(self):
+        """
+        Envía lo que el socket acepte de la cola de respuestas, hasta
+        `WRITE_QUANTUM` bytes y un pedazo generado por vez, o hasta que lo
+        frenen los límites de ancho de banda.
+        """
+        quantum = self.bytes_sent + WRITE_QUANTUM
+        pulled = False
+        while self.output and self.bytes_sent < quantum:
+            data = self.output[0]
+            if isinstance(data, PendingLog):
+                # Se terminó de enviar la respuesta de un comando.
+                self.output.popleft()
+                self.access_log.log(
+                    self.peer, data.comand, data.status,
+                    self.bytes_sent - data.sent,
+                    time.perf_counter() - data.start)
+                continue
+            if isinstance(data, FileRegion):
+                if self._throttled(data.size) or not self._send_region(data):
+                    return
+                continue
+            if not isinstance(data, memoryview):
+                # Es un iterador: le pedimos el próximo pedazo. Un pedazo
+                # por vez, así generarlo no demora a las demás conexiones.
+                if pulled:
+                    return
+                pulled = True
+                try:
+                    chunk = next(data, None)
+                except Exception as e:
+                    sys.stderr.write('Stream error: {}\n'.format(e))
+                    self._abort()
+                    return
+                if chunk is None:
+                    self.output.popleft()
+                    self.streams -= 1
+                elif len(chunk) > 0:
+                    self.output.appendleft(memoryview(chunk))
+                    self.output_size += len(chunk)
+                continue
+            if self._throttled(len(data)):
+                return
+            try:
+                if self.throttle is not None:
+                    sent = self.socket.send(data[:RATE_CHUNK])
+                else:
+                    sent = self.socket.send(data)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                self._abort()
+                return
+            self.output_size -= sent
+            self._count_sent(sent)
+            self.last_write = time.monotonic()
+            if sent < len(data):
+                self.output[0] = data[sent:]
+                return
+            self.output.popleft()
+
+    def _throttled(self, size):
+        """
+        Indica si hay que esperar a los límites de ancho de banda antes de
+        enviar `size` bytes, y anota hasta cuándo. Lo chico no espera.
+        """
+        if self.throttle is None or size <= SMALL_RESPONSE:
+            return False
+        delay = self.throttle.delay()
+        if delay <= 0:
+            return False
+        self.throttled_until = time.monotonic() + delay
+        return True
+
+    def _send_region(self, region):
+        """
+        Envía lo que se pueda de una `FileRegion` al frente de la cola.
+        Devuelve `False` si hay que esperar a que el socket esté listo.
+        """
+        chunk = SENDFILE_CHUNK if self.throttle is None else RATE_CHUNK
+        try:
+            sent = os.sendfile(self.socket.fileno(), region.file.fileno(),
+                               region.offset, min(region.size, chunk))
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            self._abort()
+            return False
+
+        self._count_sent(sent)
+        self.metrics.add('disk_bytes_read', sent)
+        self.last_write = time.monotonic()
+        region.offset += sent
+        region.size -= sent
+        if sent == 0 or region.size == 0:
+            self.output.popleft()
+            self.streams -= 1
+            region.close()
+            if region.size > 0:
+                # El archivo se achicó: cortamos la conexión.
+                self._abort()
+                return False
+        return True
+
+    def wants_read(self):
+        """
+        Indica si conviene leer más comandos: dejamos de leer mientras
+        haya muchas respuestas sin enviar.
+        """
+        return (self.connected and self.streams == 0
+                and self.output_size < MAX_PENDING_OUTPUT)
+
+    def wants_write(self):
+        """
+        Indica si hay respuestas pendientes de enviar y los límites de ancho
+        de banda lo permiten.
+        """
+        return len(self.output) > 0 and not self.throttled()
+
+    def throttled(self):
+        """
+        Indica si la conexión está esperando a los límites de ancho de
+        banda para seguir enviando.
+        """
+        return (self.throttled_until > 0
+                and time.monotonic() < self.throttled_until)
+
+    def expired(self, now):
+        """
+        Indica si la conexión no avanzó dentro de su plazo: con respuestas
+        pendientes, el de escritura; con un comando empezado, el de lectura,
+        que tiene que llegar completo a tiempo; si no (o si no hay plazo de
+        lectura), el de inactividad.
+        """
+        if self.output:
+            # El plazo corre desde que hay algo para enviar, sin contar lo
+            # que esperamos a los límites de ancho de banda.
+            since = max(self.last_write, self.last_read, self.throttled_until)
+            timeout = self.write_timeout
+        elif self.parser.pending() and self.read_timeout:
+            # Desde el primer byte del comando empezado.
+            since = self.parser.started
+            timeout = self.read_timeout
+        else:
+            since = max(self.last_write, self.last_read)
+            timeout = self.idle_timeout
+        return timeout > 0 and now - since > timeout
+
+    def finished(self):
+        """
+        La conexión terminó y ya no queda nada por enviar.
+        """
+        return not self.connected and not self.output
+
+    def close(self):
+        """
+        Cierra el socket de la conexión.
+        """
+        self._discard_output()
+        self.socket.close()
+        if self.throttle is not None:
+            self.throttle.close()
+        if self.access_pattern is not None:
+            self.access_pattern.close()
+        self.metrics.add('connections_closed')
+
+    def _abort(self):
+        """
+        El cliente se fue: descartamos lo pendiente y terminamos.
+        """
+        self.connected = False
+        self._discard_output()
+
+    def _discard_output(self):
+        """
+        Descarta lo pendiente de enviar, cerrando los iteradores para que
+        liberen los archivos que tengan abiertos.
+        """
+        for data in self.output:
+            if not isinstance(data, memoryview):
+                close = getattr(data, 'close', None)
+                if close is not None:
+                    close()
+        self.output.clear()
+        self.output_size = 0
+        self.streams = 0
+
+    def _log_command(self, comand, start, sent):
+        """
+        Como la respuesta se envía después, el comando se registra recién
+        cuando termina de enviarse, para incluir todos sus bytes.
+        """
+        if self.access_log is not None:
+            self.output.append(PendingLog(comand, self.status, start, sent))
+
+    def _send_bytes(self, data):
+        """
+        Encola bytes para enviarle al cliente.
+        """
+        if len(data) > 0:
+            self.output.append(memoryview(data))
+            self.output_size += len(data)
+
+    def _send_chunks(self, chunks):
+        """
+        Encola un iterable de pedazos de bytes, que se irá consumiendo a
+        medida que el socket acepte datos.
+        """
+        self.output.append(iter(chunks))
+        self.streams += 1
+
+    def _send_file(self, file, offset, size):
+        """
+        Encola una parte de un archivo, que se enviará con sendfile a medida
+        que el socket acepte datos.
+        """
+        if size > 0:
+            self.output.append(FileRegion(file, offset, size))
+            self.streams += 1
+        else:
+            file.close()
@@ -12,10 +12,107 @@ DEFAULT_PORT = 19500
 
 EOL = '\r\n'
 
+# Largo máximo en bytes de un comando. Alcanza para nombres de archivo de
+# varios MiB, pero evita que un cliente haga crecer el buffer sin límite.
+MAX_COMMAND_LENGTH = 2 ** 23
+
+# Modos de atención de conexiones del servidor.
+MODE_THREADS = 'threads'
+MODE_EVENTS = 'events'
+DEFAULT_MODE = MODE_THREADS
+
+# Pool de workers del servidor con threads. Con 0 workers se crea un thread
+# por conexión; si no, las conexiones esperan en una cola de a lo sumo
+# DEFAULT_QUEUE_SIZE y las que no entran se rechazan con SERVER_BUSY.
+DEFAULT_WORKERS = 0
+DEFAULT_QUEUE_SIZE = 64
+
+# Segundos que se tolera una conexión sin avanzar (0: sin límite): ociosa
+# entre comandos, sin recibir el resto de un comando empezado, o sin que el
+# cliente acepte los datos de una respuesta pendiente.
+DEFAULT_IDLE_TIMEOUT = 300
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_WRITE_TIMEOUT = 60
+# Cada cuántos segundos el servidor de eventos revisa esos plazos.
+TIMEOUT_SWEEP_INTERVAL = 1.0
+
+# Procesos que atienden conexiones en el mismo puerto (1: sin prefork). Un
+# proceso que muere antes de MIN_PROCESS_LIFETIME segundos se reinicia
+# recién después de esperar ese tiempo, para no reiniciarlo en loop.
+DEFAULT_PROCESSES = 1
+MIN_PROCESS_LIFETIME = 1.0
+
+# Límites de ancho de banda de las respuestas, en bytes por segundo (0: sin
+# límite): del servidor en total, de cada IP de cliente y de cada conexión.
+DEFAULT_RATE_LIMIT = 0
+DEFAULT_IP_RATE_LIMIT = 0
+DEFAULT_CONNECTION_RATE_LIMIT = 0
+
+# Bytes de respuestas encoladas a partir de los cuales el loop de eventos
+# deja de leer comandos de esa conexión hasta que el cliente los consuma.
+MAX_PENDING_OUTPUT = 2 ** 20
+
+# Rutas cuyos metadatos se cachean (0 desactiva el cache), y cada cuántos
+# segundos se revisan si el sistema no permite que avise de los cambios.
+DEFAULT_STAT_CACHE_SIZE = 4096
+STAT_POLL_INTERVAL = 1.0
+
+# Bytes de respuestas de get_slice ya codificadas que se cachean
+# (0 desactiva el cache).
+DEFAULT_SLICE_CACHE_SIZE = 0
+
+# Tamaño máximo de los slices cuya lectura y codificación se comparte entre
+# pedidos de get_slice iguales simultáneos (0: no se comparte).
+DEFAULT_SHARED_SLICE_SIZE = 2 ** 20
+
+# Bytes que se pueden haber pedido al disco por adelantado, y todavía no
+# leído, para las conexiones que recorren archivos en orden (0: no se lee
+# por adelantado).
+DEFAULT_READAHEAD_BUDGET = 2 ** 26
+
+# Archivos que se mantienen abiertos para leer slices (0: se abren y cierran
+# en cada pedido).
+DEFAULT_FD_POOL_SIZE = 128
+
+# Tamaños de bloque admitidos por get_block_hashes.
+MIN_HASH_BLOCK = 1024
+MAX_HASH_BLOCK = 2 ** 26
+# Cantidad máxima de bloques de una respuesta de get_block_hashes: en
+# archivos grandes, el tamaño de bloque mínimo crece para respetarla.
+MAX_HASH_BLOCKS = 2 ** 16
+
+# Entradas (archivo y tamaño de bloque) del cache de hashes por bloque
+# (0 desactiva el cache).
+DEFAULT_HASH_CACHE_SIZE = 256
+
+# Compresión de get_slice: nivel máximo de zlib, y codificaciones que puede
+# indicar el servidor para cada fragmento.
+MAX_COMPRESSION_LEVEL = 9
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_IDENTITY = 'identity'
+
+# Registro de accesos: fracción de los comandos que se registran, y
+# entradas que pueden esperar al thread escritor antes de descartarlas.
+DEFAULT_LOG_SAMPLE = 1.0
+DEFAULT_LOG_QUEUE_SIZE = 8192
+
+# Límites de get_slices: cantidad de rangos por pedido, y bytes pedidos en
+# total (y también leídos del archivo, contando una sola vez lo que se
+# superpone).
+MAX_BATCH_RANGES = 1024
+MAX_BATCH_BYTES = 2 ** 26
+
+# Cursores de get_file_listing_page para pedir la primera página, y que
+# indica que no quedan más. Los demás cursores son nombres en hexa, así que
+# no se confunden con estos.
+LISTING_START = '-'
+LISTING_END = '.'
+
 
 CODE_OK = 0
 BAD_EOL = 100
 BAD_REQUEST = 101
+SERVER_BUSY = 102
 INTERNAL_ERROR = 199
 INVALID_COMMAND = 200
 INVALID_ARGUMENTS = 201
@@ -28,6 +125,7 @@ error_messages = {
     # 1xx: Errores fatales (no se pueden atender más pedidos)
     BAD_EOL: "BAD EOL",
     BAD_REQUEST: "BAD REQUEST",
+    SERVER_BUSY: "SERVER BUSY",
     INTERNAL_ERROR: "INTERNAL SERVER ERROR",
     # 2xx: Errores no fatales (no se pudo atender este pedido)
     INVALID_COMMAND: "NO SUCH COMMAND",
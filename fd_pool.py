@@ -0,0 +1,200 @@
+# encoding: utf-8
+# Pool de descriptores de archivos abiertos, compartido por todas las
+# conexiones del proceso.
+
+import os
+import threading
+from collections import OrderedDict
+from stat_cache import FileStat
+
+# Máximo de buffers por llamada a `os.preadv`.
+IOV_MAX = 1024
+if hasattr(os, 'sysconf') and 'SC_IOV_MAX' in os.sysconf_names:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+
+
+class OpenFile(object):
+    """
+    Archivo abierto para leer por posición con `os.pread`. Como no usa la
+    posición compartida del descriptor, varios threads pueden leer del
+    mismo a la vez.
+    """
+
+    def __init__(self, fd, on_close=os.close):
+        self.fd = fd
+        self.on_close = on_close
+        self.closed = False
+
+    def fileno(self):
+        return self.fd
+
+    def pread(self, size, offset):
+        """
+        Lee hasta `size` bytes desde `offset`. Devuelve menos solo si se
+        llegó al final del archivo.
+        """
+        data = os.pread(self.fd, size, offset)
+        while 0 < len(data) < size:
+            more = os.pread(self.fd, size - len(data), offset + len(data))
+            if not more:
+                break
+            data += more
+        return data
+
+    def pread_into(self, buffer, offset):
+        """
+        Llena `buffer` con los bytes del archivo desde `offset`, leyendo con
+        `os.preadv` directamente en él. Devuelve la cantidad de bytes
+        leídos, que es menor al tamaño del buffer solo si se llegó al final
+        del archivo.
+        """
+        return self.preadv_into([buffer], offset)
+
+    def preadv_into(self, buffers, offset):
+        """
+        Llena, en orden, los buffers de `buffers` con los bytes del archivo
+        desde `offset`, con una llamada a `os.preadv` por cada `IOV_MAX`
+        buffers (y las que hagan falta si la lectura queda corta). Devuelve
+        la cantidad de bytes leídos, que es menor al total de los buffers
+        solo si se llegó al final del archivo.
+        """
+        views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+        filled = 0
+        first = 0
+        while first < len(views):
+            if hasattr(os, 'preadv'):
+                count = os.preadv(self.fd, views[first:first + IOV_MAX],
+                                  offset + filled)
+            else:
+                view = views[first]
+                data = os.pread(self.fd, len(view), offset + filled)
+                count = len(data)
+                view[:count] = data
+            if count == 0:
+                break
+            filled += count
+            # Salteamos los buffers llenos y recortamos el que quedó a medias.
+            while first < len(views) and count >= len(views[first]):
+                count -= len(views[first])
+                first += 1
+            if count:
+                views[first] = views[first][count:]
+        return filled
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.on_close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_file(path):
+    """
+    Abre `path` para lectura, sin pasar por un pool.
+    """
+    return OpenFile(os.open(path, os.O_RDONLY | os.O_CLOEXEC))
+
+
+class PooledFile(object):
+    """
+    Descriptor del pool, con la versión del archivo que tiene abierta y la
+    cantidad de `OpenFile` que lo están usando.
+    """
+
+    def __init__(self, path, fd, file_info):
+        self.path = path
+        self.fd = fd
+        self.file_info = file_info
+        self.users = 0
+        self.evicted = False
+
+
+class FilePool(object):
+    """
+    Mantiene abiertos a lo sumo `max_files` descriptores de los archivos
+    usados más recientemente, para no abrir y cerrar el archivo en cada
+    get_slice.
+
+    Cada descriptor recuerda el `FileStat` del archivo que abrió: si el
+    archivo se reemplaza, el descriptor viejo se descarta. Un descriptor
+    descartado mientras alguien lo usa se cierra cuando lo liberan.
+    """
+
+    def __init__(self, max_files):
+        self.max_files = max_files
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def open(self, path, file_info):
+        """
+        Devuelve un `OpenFile` de `path` que corresponda a la versión
+        `file_info` del archivo. Lanza `OSError` si no se puede abrir.
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            pooled = self.files.get(path)
+            if pooled is not None:
+                if pooled.file_info == file_info:
+                    self.files.move_to_end(path)
+                    return self._lease(pooled)
+                self._evict(pooled)
+
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        st = os.fstat(fd)
+        opened = FileStat(st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+        if opened != file_info:
+            # El archivo cambió desde que se consultó: no lo guardamos.
+            return OpenFile(fd)
+
+        with self.lock:
+            pooled = self.files.get(path)
+            if pooled is not None and pooled.file_info == file_info:
+                # Otro thread lo abrió mientras tanto.
+                os.close(fd)
+                return self._lease(pooled)
+            if pooled is not None:
+                self._evict(pooled)
+            pooled = PooledFile(path, fd, file_info)
+            self.files[path] = pooled
+            while len(self.files) > self.max_files:
+                old_path, old = self.files.popitem(last=False)
+                self._evict(old)
+            return self._lease(pooled)
+
+    def invalidate(self, path):
+        """
+        Descarta el descriptor de `path`, o todos si es `None`. Se registra
+        como listener del `StatCache`.
+        """
+        with self.lock:
+            if path is None:
+                pooled_files = list(self.files.values())
+            elif path in self.files:
+                pooled_files = [self.files[path]]
+            else:
+                pooled_files = []
+            for pooled in pooled_files:
+                self._evict(pooled)
+
+    def _lease(self, pooled):
+        pooled.users += 1
+        return OpenFile(pooled.fd, lambda fd: self._release(pooled))
+
+    def _release(self, pooled):
+        with self.lock:
+            pooled.users -= 1
+            if pooled.evicted and pooled.users == 0:
+                os.close(pooled.fd)
+
+    def _evict(self, pooled):
+        if self.files.get(pooled.path) is pooled:
+            del self.files[pooled.path]
+        if not pooled.evicted:
+            pooled.evicted = True
+            if pooled.users == 0:
+                os.close(pooled.fd)
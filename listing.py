@@ -0,0 +1,79 @@
+# encoding: utf-8
+# Listado ordenado del directorio servido, para atender get_file_listing_page
+# sin recorrer el directorio entero en cada página.
+
+import os
+import time
+import bisect
+import threading
+
+# Un directorio modificado hace menos que esto puede volver a cambiar sin
+# que cambie su mtime, por la resolución del reloj del sistema de archivos:
+# su listado no se reusa.
+RACY_INTERVAL = 0.05
+
+
+def listable(name):
+    """
+    Indica si un nombre de archivo se puede enviar en un listado: tiene que
+    ser ASCII y no contener el `EOL`, o el cliente no podría separarlo de
+    los demás.
+    """
+    try:
+        name.encode("ascii")
+    except UnicodeEncodeError:
+        return False
+    return '\r' not in name and '\n' not in name
+
+
+class ListingSnapshot(object):
+    """
+    Nombres listables de `directory` en orden alfabético. Se arma una vez
+    y se reusa mientras el directorio sea el mismo y no cambie su mtime,
+    así que cada página cuesta una búsqueda binaria en lugar de recorrer el
+    directorio.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.names = []
+        # `(st_dev, st_ino, st_mtime_ns)` del directorio listado en `names`.
+        self.version = None
+        self.lock = threading.Lock()
+
+    def page(self, after, limit):
+        """
+        Devuelve un par `(nombres, quedan)`: los a lo sumo `limit` nombres
+        posteriores a `after` (desde el principio si es `None`), y si hay
+        más después de ellos.
+        """
+        names = self._snapshot()
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(names, after)
+        return names[start:start + limit], start + limit < len(names)
+
+    def _snapshot(self):
+        now = time.time()
+        try:
+            st = os.stat(self.directory)
+        except FileNotFoundError:
+            return []
+        version = (st.st_dev, st.st_ino, st.st_mtime_ns)
+        with self.lock:
+            if version == self.version:
+                return self.names
+
+        # Recorremos el directorio sin el lock: otras conexiones siguen
+        # usando el listado anterior mientras tanto.
+        try:
+            with os.scandir(self.directory) as entries:
+                names = sorted(entry.name for entry in entries
+                               if listable(entry.name))
+        except FileNotFoundError:
+            return []
+        if now - st.st_mtime_ns / 1e9 > RACY_INTERVAL:
+            with self.lock:
+                self.names = names
+                self.version = version
+        return names
@@ -0,0 +1,277 @@
+# encoding: utf-8
+# Métricas del servidor: comandos, latencias, códigos de respuesta, bytes y
+# conexiones, compartidas por todas las conexiones del proceso.
+
+import time
+import bisect
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# Límites superiores, en segundos, de los buckets del histograma de
+# latencia de cada comando. Hay un bucket más para lo que los supera.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Contadores de `Metrics.add`, con su descripción para Prometheus.
+COUNTERS = {
+    'connections_total': "Conexiones aceptadas.",
+    'connections_closed': "Conexiones cerradas.",
+    'connections_reaped': "Conexiones cerradas por exceder un plazo.",
+    'bytes_sent': "Bytes enviados a los clientes.",
+    'disk_bytes_read': "Bytes leídos de los archivos servidos.",
+    'readahead_bytes': "Bytes de recorridos secuenciales pedidos al disco "
+                       "por adelantado.",
+    'slices_shared': "Pedidos de get_slice que usaron la lectura de otro "
+                     "pedido igual simultáneo.",
+}
+
+
+class Histogram(object):
+    """
+    Cantidad de observaciones por bucket de `LATENCY_BUCKETS`, y su suma.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    def merge(self, other):
+        for i, count in enumerate(list(other.counts)):
+            self.counts[i] += count
+        self.sum += other.sum
+
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, fraction):
+        """
+        Estima el cuantil `fraction` como el límite superior del bucket que
+        lo contiene (infinito si supera al último).
+        """
+        rank = fraction * self.count()
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count > 0 and seen >= rank:
+                if i < len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[i]
+                return float('inf')
+        return 0.0
+
+
+class Shard(object):
+    """
+    Métricas de un thread. Solo las modifica el thread dueño, así que no
+    necesitan lock.
+    """
+
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.statuses = {}
+        self.commands = {}
+
+    def merge(self, other):
+        for name, value in dict(other.counters).items():
+            self.counters[name] = self.counters.get(name, 0) + value
+        for code, count in dict(other.statuses).items():
+            self.statuses[code] = self.statuses.get(code, 0) + count
+        for command, histogram in dict(other.commands).items():
+            self.commands.setdefault(command, Histogram()).merge(histogram)
+
+
+class Metrics(object):
+    """
+    Métricas de todas las conexiones del servidor.
+
+    Cada thread anota en su propio `Shard`, sin tomar ningún lock. Al
+    consultar, se suman los shards de todos los threads. Cuando una conexión
+    termina, su thread vuelca el shard en el total con `retire_thread`, así
+    los threads que terminan no dejan shards acumulados.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        # Lo volcado por threads que ya no tienen shard.
+        self.retired = Shard()
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        # Pares (prefijo, función) de `add_source`.
+        self.sources = []
+
+    def add_source(self, prefix, stats):
+        """
+        Agrega a las métricas los valores de otro componente: `stats()`
+        devuelve un diccionario, que se consulta en cada snapshot, y cada
+        clave se publica como `prefix_clave`.
+        """
+        self.sources.append((prefix, stats))
+
+    def _source_values(self):
+        values = []
+        for prefix, stats in self.sources:
+            for name, value in sorted(stats().items()):
+                values.append(('%s_%s' % (prefix, name), value))
+        return values
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = Shard()
+            with self.lock:
+                self.shards.append(shard)
+            self.local.shard = shard
+        return shard
+
+    def add(self, name, value=1):
+        """
+        Suma `value` al contador `name` de `COUNTERS`.
+        """
+        counters = self._shard().counters
+        counters[name] += value
+
+    def status(self, code):
+        """
+        Anota una respuesta con el código `code`.
+        """
+        statuses = self._shard().statuses
+        statuses[code] = statuses.get(code, 0) + 1
+
+    def observe(self, command, seconds):
+        """
+        Anota que el comando `command` tardó `seconds` segundos.
+        """
+        commands = self._shard().commands
+        histogram = commands.get(command)
+        if histogram is None:
+            histogram = commands[command] = Histogram()
+        histogram.observe(seconds)
+
+    def retire_thread(self):
+        """
+        Vuelca el shard del thread actual en el total y lo descarta.
+        """
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            return
+        with self.lock:
+            self.retired.merge(shard)
+            self.shards.remove(shard)
+        self.local.shard = None
+
+    def totals(self):
+        """
+        Devuelve un `Shard` con la suma de las métricas de todos los
+        threads.
+        """
+        total = Shard()
+        with self.lock:
+            total.merge(self.retired)
+            for shard in self.shards:
+                total.merge(shard)
+        return total
+
+    def snapshot(self):
+        """
+        Devuelve una lista de pares `(nombre, valor)` con el estado de las
+        métricas, para el comando get_stats.
+        """
+        total = self.totals()
+        counters = total.counters
+        stats = [
+            ('uptime_seconds', round(time.monotonic() - self.started, 3)),
+            ('connections_active',
+             counters['connections_total'] - counters['connections_closed']),
+        ]
+        stats.extend(sorted(counters.items()))
+        stats.extend(self._source_values())
+        for code, count in sorted(total.statuses.items()):
+            stats.append(('status_%d' % code, count))
+        for command, histogram in sorted(total.commands.items()):
+            prefix = 'command_%s_' % command
+            stats.append((prefix + 'count', histogram.count()))
+            stats.append((prefix + 'seconds_sum', round(histogram.sum, 6)))
+            for name, fraction in (('p50', 0.5), ('p99', 0.99),
+                                   ('p999', 0.999)):
+                stats.append((prefix + name + '_seconds',
+                              histogram.quantile(fraction)))
+        return stats
+
+    def prometheus(self):
+        """
+        Devuelve las métricas en el formato de texto de Prometheus.
+        """
+        total = self.totals()
+        counters = total.counters
+        lines = [
+            '# HELP hftp_connections_active Conexiones abiertas.',
+            '# TYPE hftp_connections_active gauge',
+            'hftp_connections_active %d' % (counters['connections_total']
+                                            - counters['connections_closed']),
+        ]
+        for name, description in sorted(COUNTERS.items()):
+            metric = 'hftp_' + name
+            if not metric.endswith('_total'):
+                metric += '_total'
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % metric)
+            lines.append('%s %d' % (metric, counters[name]))
+
+        for name, value in self._source_values():
+            lines.append('# TYPE hftp_%s untyped' % name)
+            lines.append('hftp_%s %s' % (name, value))
+
+        lines.append('# HELP hftp_responses_total Respuestas por código.')
+        lines.append('# TYPE hftp_responses_total counter')
+        for code, count in sorted(total.statuses.items()):
+            lines.append('hftp_responses_total{code="%d"} %d' % (code, count))
+
+        lines.append('# HELP hftp_command_duration_seconds Tiempo de '
+                     'atención de cada comando.')
+        lines.append('# TYPE hftp_command_duration_seconds histogram')
+        for command, histogram in sorted(total.commands.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',),
+                                    histogram.counts):
+                cumulative += count
+                lines.append(
+                    'hftp_command_duration_seconds_bucket'
+                    '{command="%s",le="%s"} %d' % (command, bound, cumulative))
+            lines.append('hftp_command_duration_seconds_sum{command="%s"} %f'
+                         % (command, histogram.sum))
+            lines.append('hftp_command_duration_seconds_count{command="%s"} %d'
+                         % (command, cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+class PrometheusHandler(BaseHTTPRequestHandler):
+    """
+    Responde cualquier GET con las métricas del servidor.
+    """
+
+    def do_GET(self):
+        body = self.server.metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_prometheus(metrics, port, addr='127.0.0.1'):
+    """
+    Sirve las métricas por HTTP en `addr:port`, desde un thread aparte.
+    Devuelve el `HTTPServer`.
+    """
+    server = HTTPServer((addr, port), PrometheusHandler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
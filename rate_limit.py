@@ -0,0 +1,121 @@
+# encoding: utf-8
+# Límites de ancho de banda de las respuestas: global, por IP del cliente y
+# por conexión.
+
+import time
+import threading
+
+# Bytes que se envían por vez en una conexión con límite, para que sus
+# esperas sean cortas y se intercalen con las demás conexiones.
+RATE_CHUNK = 2 ** 16
+# Los envíos de a lo sumo estos bytes no esperan: se cobran igual, pero las
+# respuestas chicas no quedan atrás de las transferencias grandes.
+SMALL_RESPONSE = 2 ** 13
+
+
+class TokenBucket(object):
+    """
+    Balde de `rate` bytes por segundo que acumula hasta `burst` bytes. Se
+    puede gastar de más: el balde queda en deuda hasta que se recupera.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def charge(self, amount):
+        """
+        Descuenta `amount` bytes enviados.
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+    def delay(self):
+        """
+        Devuelve los segundos que faltan para salir de la deuda.
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class Throttle(object):
+    """
+    Los baldes que limitan a una conexión: el suyo, el de su IP y el global.
+    """
+
+    def __init__(self, limiter, ip, buckets):
+        self.limiter = limiter
+        self.ip = ip
+        self.buckets = buckets
+
+    def charge(self, amount):
+        for bucket in self.buckets:
+            bucket.charge(amount)
+
+    def delay(self):
+        """
+        Segundos que la conexión tiene que esperar antes de enviar más.
+        """
+        return max(bucket.delay() for bucket in self.buckets)
+
+    def close(self):
+        self.limiter._release(self.ip)
+
+
+class RateLimiter(object):
+    """
+    Límites de bytes por segundo enviados en total (`global_rate`), a cada
+    IP (`ip_rate`) y por cada conexión (`connection_rate`). Un límite en 0
+    no se aplica. Los baldes de cada IP se comparten entre sus conexiones y
+    se descartan cuando se cierra la última.
+    """
+
+    def __init__(self, global_rate=0, ip_rate=0, connection_rate=0):
+        self.global_bucket = TokenBucket(global_rate) if global_rate else None
+        self.ip_rate = ip_rate
+        self.connection_rate = connection_rate
+        # IP -> [balde, conexiones abiertas].
+        self.ips = {}
+        self.lock = threading.Lock()
+
+    def throttle(self, ip):
+        """
+        Devuelve el `Throttle` de una nueva conexión desde `ip`, o `None` si
+        no hay límites. Hay que cerrarlo al cerrar la conexión.
+        """
+        buckets = []
+        if self.global_bucket is not None:
+            buckets.append(self.global_bucket)
+        if self.ip_rate:
+            with self.lock:
+                entry = self.ips.get(ip)
+                if entry is None:
+                    entry = self.ips[ip] = [TokenBucket(self.ip_rate), 0]
+                entry[1] += 1
+            buckets.append(entry[0])
+        if self.connection_rate:
+            buckets.append(TokenBucket(self.connection_rate))
+        if not buckets:
+            return None
+        return Throttle(self, ip, buckets)
+
+    def _release(self, ip):
+        if not self.ip_rate:
+            return
+        with self.lock:
+            entry = self.ips[ip]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.ips[ip]
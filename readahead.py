@@ -0,0 +1,148 @@
+# encoding: utf-8
+# Lectura anticipada de los archivos que los clientes recorren en orden,
+# hecha desde un thread aparte para que las conexiones no la esperen.
+
+import os
+import sys
+import queue
+import threading
+
+# Ventana de lectura anticipada de una conexión: empieza en el mínimo al
+# detectar un recorrido secuencial y se duplica en cada pedido que lo
+# continúa, hasta el máximo.
+MIN_WINDOW = 2 ** 17
+MAX_WINDOW = 2 ** 23
+# Bytes que se leen por vez donde no hay `posix_fadvise`.
+READ_CHUNK = 2 ** 20
+
+
+class ReadAhead(object):
+    """
+    Pide al disco, desde un thread aparte, partes de archivos que se van a
+    leer pronto: con `posix_fadvise(WILLNEED)` si está disponible, o
+    leyéndolas y descartándolas, para que queden en el cache de páginas del
+    sistema.
+
+    Lo pedido por adelantado y todavía no leído por las conexiones ocupa a
+    lo sumo `budget` bytes entre todas.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        reader = threading.Thread(target=self._read_requests, daemon=True)
+        reader.start()
+
+    def reserve(self, size):
+        """
+        Reserva hasta `size` bytes del presupuesto. Devuelve cuántos se
+        reservaron.
+        """
+        with self.lock:
+            granted = max(min(size, self.budget - self.used), 0)
+            self.used += granted
+            return granted
+
+    def release(self, size):
+        """
+        Devuelve al presupuesto `size` bytes reservados.
+        """
+        with self.lock:
+            self.used -= size
+
+    def submit(self, path, offset, size):
+        """
+        Encola la lectura anticipada de `size` bytes de `path` desde
+        `offset`.
+        """
+        self.requests.put((path, offset, size))
+
+    def _read_requests(self):
+        """
+        Thread lector: atiende los pedidos de lectura anticipada en orden.
+        """
+        while True:
+            path, offset, size = self.requests.get()
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                # El archivo ya no está: nadie va a leerlo.
+                continue
+            try:
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(fd, offset, size, os.POSIX_FADV_WILLNEED)
+                else:
+                    while size > 0:
+                        chunk = os.pread(fd, min(size, READ_CHUNK), offset)
+                        if not chunk:
+                            break
+                        offset += len(chunk)
+                        size -= len(chunk)
+            except OSError as e:
+                sys.stderr.write('read-ahead: {}\n'.format(e))
+            finally:
+                os.close(fd)
+
+
+class AccessPattern(object):
+    """
+    Sigue los pedidos de slices de una conexión. Cuando un pedido empieza
+    donde terminó el anterior del mismo archivo, el recorrido es secuencial
+    y se pide por adelantado la ventana que sigue, cada vez más grande. Un
+    pedido que no sigue al anterior vuelve a empezar.
+    """
+
+    def __init__(self, readahead):
+        self.readahead = readahead
+        # Archivo recorrido como `(ruta, FileStat)`, y dónde debería empezar
+        # el próximo pedido secuencial.
+        self.file = None
+        self.position = 0
+        self.window = 0
+        # Hasta dónde se pidió por adelantado, y cuánto del presupuesto
+        # ocupa lo pedido que todavía no se leyó.
+        self.ahead = 0
+        self.reserved = 0
+
+    def access(self, path, file_info, offset, size):
+        """
+        Anota un pedido de `size` bytes de `path` desde `offset`. Devuelve
+        los bytes que se pidieron por adelantado.
+        """
+        if (path, file_info) == self.file and offset == self.position:
+            self.window = min(max(self.window * 2, MIN_WINDOW), MAX_WINDOW)
+        else:
+            self._forget()
+            self.file = (path, file_info)
+            self.window = 0
+        self.position = offset + size
+
+        # Lo que ya se leyó deja de ocupar el presupuesto.
+        pending = max(self.ahead - self.position, 0)
+        self.readahead.release(self.reserved - pending)
+        self.reserved = pending
+        if self.window == 0:
+            return 0
+
+        start = max(self.ahead, self.position)
+        end = min(self.position + self.window, file_info.size)
+        size = self.readahead.reserve(end - start)
+        if size == 0:
+            return 0
+        self.readahead.submit(path, start, size)
+        self.ahead = start + size
+        self.reserved += size
+        return size
+
+    def close(self):
+        """
+        Libera lo que queda reservado. Se llama al cerrar la conexión.
+        """
+        self._forget()
+
+    def _forget(self):
+        self.readahead.release(self.reserved)
+        self.reserved = 0
+        self.ahead = 0
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# Benchmark de carga del servidor HFTP: levanta un server en un puerto libre
+# con un directorio de datos generado, lo carga con muchos clientes
+# concurrentes y reporta throughput, latencia y memoria en JSON.
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import select
+import shutil
+import socket
+import optparse
+import tempfile
+import threading
+import subprocess
+import client
+from constants import *
+
+# Mezcla de comandos por defecto: nombre -> peso relativo.
+DEFAULT_MIX = 'listing=1,metadata=10,slice=10'
+DEFAULT_CLIENTS = 16
+DEFAULT_DURATION = 10.0
+DEFAULT_FILES = 100
+DEFAULT_FILE_SIZE = 2 ** 20
+DEFAULT_SLICE_SIZE = 2 ** 16
+# Diferencia relativa con el baseline a partir de la cual se reporta una
+# regresión.
+DEFAULT_TOLERANCE = 0.1
+# Segundos que se espera a que el server empiece a escuchar.
+SERVER_START_TIMEOUT = 10
+# Métricas comparadas con el baseline, y si más es mejor para cada una.
+COMPARED_METRICS = [
+    ('requests_per_s', True),
+    ('mb_per_s', True),
+    ('latency_p50_ms', False),
+    ('latency_p99_ms', False),
+    ('latency_p999_ms', False),
+    ('server_rss_kb', False),
+]
+
+
+def parse_mix(text):
+    """
+    Parsea una mezcla `comando=peso,...`. Devuelve un par de listas
+    (comandos, pesos), o lanza `ValueError` si es inválida.
+    """
+    commands, weights = [], []
+    for item in text.split(','):
+        command, _, weight = item.partition('=')
+        if command not in OPERATIONS or not weight.isdigit():
+            raise ValueError("Mezcla de comandos invalida: %s" % item)
+        commands.append(command)
+        weights.append(int(weight))
+    if sum(weights) == 0:
+        raise ValueError("La mezcla de comandos no tiene pesos")
+    return commands, weights
+
+
+def generate_dataset(directory, files, file_size):
+    """
+    Crea `files` archivos de `file_size` bytes al azar en `directory`.
+    Devuelve la lista de nombres.
+    """
+    names = []
+    for i in range(files):
+        name = 'bench%05d' % i
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(os.urandom(file_size))
+        names.append(name)
+    return names
+
+
+class BenchServer(object):
+    """
+    Un `server.py` corriendo en otro proceso, escuchando en un puerto elegido
+    por el sistema. Se corre aparte para que la carga de los clientes no
+    compita por el GIL del server y para poder medir su memoria.
+    """
+
+    def __init__(self, directory, server_args):
+        command = [sys.executable, '-u', 'server.py', '-p', '0',
+                   '-d', directory] + server_args
+        self.process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        # El server anuncia el puerto en su primera línea:
+        #     Serving DIRECTORIO on DIRECCION:PUERTO.
+        # o, en modo prefork:
+        #     Supervising N processes on DIRECCION:PUERTO.
+        ready, _, __ = select.select([self.process.stdout], [], [],
+                                     SERVER_START_TIMEOUT)
+        line = self.process.stdout.readline() if ready else ''
+        if not line.startswith(('Serving', 'Supervising')):
+            self.stop()
+            raise RuntimeError("El server no arrancó: %r" % line)
+        address = line.rstrip().rstrip('.').rsplit(' ', 1)[1]
+        self.addr, port = address.rsplit(':', 1)
+        self.port = int(port)
+        self._wait_listening()
+        # Descartamos el resto de la salida, para que el server nunca se
+        # bloquee escribiendo en un pipe lleno.
+        drain = threading.Thread(target=self._drain, daemon=True)
+        drain.start()
+
+    def _wait_listening(self):
+        """
+        Espera a que el server acepte conexiones: en modo prefork anuncia el
+        puerto antes de que sus procesos empiecen a escuchar.
+        """
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while True:
+            try:
+                socket.create_connection((self.addr, self.port)).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError("El server no acepta conexiones")
+                time.sleep(0.05)
+
+    def _drain(self):
+        for line in self.process.stdout:
+            pass
+
+    def memory(self):
+        """
+        Devuelve un par (RSS actual, RSS máximo) del server en KiB, sumando
+        los procesos hijos en modo prefork, leído de /proc, o (None, None)
+        si no está disponible.
+        """
+        pid = self.process.pid
+        pids = [pid]
+        try:
+            with open('/proc/%d/task/%d/children' % (pid, pid)) as children:
+                pids.extend(int(child) for child in children.read().split())
+        except OSError:
+            pass
+        values = {}
+        for pid in pids:
+            try:
+                with open('/proc/%d/status' % pid) as status:
+                    for line in status:
+                        key, _, value = line.partition(':')
+                        if key in ('VmRSS', 'VmHWM'):
+                            values[key] = (values.get(key, 0)
+                                           + int(value.split()[0]))
+            except OSError:
+                pass
+        return values.get('VmRSS'), values.get('VmHWM')
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def op_listing(c, names, options):
+    return c.file_lookup(), 0
+
+
+def op_metadata(c, names, options):
+    return c.get_metadata(random.choice(names)), 0
+
+
+def op_slice(c, names, options):
+    size = min(options.slice_size, options.file_size)
+    offset = random.randint(0, options.file_size - size)
+    result = c.pipeline(1).get_slice(random.choice(names), offset, size)
+    data = result.result()
+    return data, len(data or b'')
+
+
+# Comando de la mezcla -> función que lo ejecuta con un `client.Client` y
+# devuelve (resultado, bytes de datos recibidos).
+OPERATIONS = {
+    'listing': op_listing,
+    'metadata': op_metadata,
+    'slice': op_slice,
+}
+
+
+class Worker(threading.Thread):
+    """
+    Un cliente del benchmark: ejecuta comandos elegidos al azar según la
+    mezcla hasta `deadline`, anotando la latencia de cada uno.
+    """
+
+    def __init__(self, server, names, commands, weights, deadline, options):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = server
+        self.names = names
+        self.commands = commands
+        self.weights = weights
+        self.deadline = deadline
+        self.options = options
+        self.latencies = []
+        self.counts = dict.fromkeys(commands, 0)
+        self.received = 0
+        self.errors = 0
+
+    def run(self):
+        try:
+            c = client.Client(self.server.addr, self.server.port)
+        except OSError:
+            self.errors += 1
+            return
+        while time.monotonic() < self.deadline:
+            command = random.choices(self.commands, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                result, received = OPERATIONS[command](
+                    c, self.names, self.options)
+            except OSError:
+                self.errors += 1
+                return
+            self.latencies.append(time.perf_counter() - start)
+            self.counts[command] += 1
+            self.received += received
+            if c.status != CODE_OK:
+                self.errors += 1
+            if not c.connected:
+                return
+        c.close()
+
+
+def percentile(values, fraction):
+    """
+    Percentil `fraction` (entre 0 y 1) de la lista ordenada `values`.
+    """
+    if not values:
+        return None
+    index = max(math.ceil(fraction * len(values)) - 1, 0)
+    return values[index]
+
+
+def run_benchmark(options, server_args):
+    """
+    Corre el benchmark y devuelve el diccionario de resultados.
+    """
+    commands, weights = parse_mix(options.mix)
+    directory = tempfile.mkdtemp(prefix='hftp-bench-')
+    try:
+        names = generate_dataset(directory, options.files, options.file_size)
+        server = BenchServer(directory, server_args)
+        try:
+            start = time.monotonic()
+            deadline = start + options.duration
+            workers = [Worker(server, names, commands, weights, deadline,
+                              options)
+                       for _ in range(options.clients)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.monotonic() - start
+            rss, peak_rss = server.memory()
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(directory)
+
+    latencies = sorted(l for w in workers for l in w.latencies)
+    counts = dict.fromkeys(commands, 0)
+    for worker in workers:
+        for command, count in worker.counts.items():
+            counts[command] += count
+    received = sum(w.received for w in workers)
+
+    def millis(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        'config': {
+            'mix': options.mix,
+            'clients': options.clients,
+            'duration': options.duration,
+            'files': options.files,
+            'file_size': options.file_size,
+            'slice_size': options.slice_size,
+            'server_args': server_args,
+        },
+        'requests': len(latencies),
+        'commands': counts,
+        'errors': sum(w.errors for w in workers),
+        'elapsed_s': round(elapsed, 3),
+        'requests_per_s': round(len(latencies) / elapsed, 1),
+        'mb_per_s': round(received / elapsed / 2 ** 20, 2),
+        'latency_p50_ms': millis(percentile(latencies, 0.5)),
+        'latency_p99_ms': millis(percentile(latencies, 0.99)),
+        'latency_p999_ms': millis(percentile(latencies, 0.999)),
+        'server_rss_kb': rss,
+        'server_peak_rss_kb': peak_rss,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compara los resultados con un baseline. Devuelve la lista de
+    regresiones: métricas que empeoraron más que `tolerance` (relativo).
+    """
+    regressions = []
+    for metric, higher_is_better in COMPARED_METRICS:
+        old, new = baseline.get(metric), results.get(metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        if higher_is_better:
+            change = -change
+        if change > tolerance:
+            regressions.append({
+                'metric': metric,
+                'baseline': old,
+                'current': new,
+                'change': round(change, 3),
+            })
+    return regressions
+
+
+def main():
+    """Parsea los argumentos y corre el benchmark"""
+
+    parser = optparse.OptionParser(
+        usage="%prog [options] [-- opciones de server.py]")
+    parser.add_option(
+        "-c", "--clients", type="int",
+        help="Clientes concurrentes", default=DEFAULT_CLIENTS)
+    parser.add_option(
+        "-t", "--duration", type="float",
+        help="Segundos que dura la carga", default=DEFAULT_DURATION)
+    parser.add_option(
+        "-x", "--mix",
+        help="Mezcla de comandos, como pesos relativos de listing, metadata "
+        "y slice", default=DEFAULT_MIX)
+    parser.add_option(
+        "--files", type="int",
+        help="Cantidad de archivos generados", default=DEFAULT_FILES)
+    parser.add_option(
+        "--file-size", type="int",
+        help="Bytes de cada archivo generado", default=DEFAULT_FILE_SIZE)
+    parser.add_option(
+        "--slice-size", type="int",
+        help="Bytes pedidos en cada get_slice", default=DEFAULT_SLICE_SIZE)
+    parser.add_option(
+        "-o", "--output",
+        help="Archivo donde guardar los resultados (sirve como baseline)")
+    parser.add_option(
+        "-b", "--baseline",
+        help="Resultados anteriores con los que comparar")
+    parser.add_option(
+        "--tolerance", type="float",
+        help="Empeoramiento relativo tolerado respecto al baseline",
+        default=DEFAULT_TOLERANCE)
+
+    options, server_args = parser.parse_args()
+    if (options.clients < 1 or options.duration <= 0 or options.files < 1
+            or options.file_size < 1 or options.slice_size < 1
+            or options.tolerance < 0):
+        parser.print_help()
+        sys.exit(1)
+    try:
+        parse_mix(options.mix)
+    except ValueError as e:
+        sys.stderr.write('{}\n'.format(e))
+        sys.exit(1)
+
+    results = run_benchmark(options, server_args)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        results['regressions'] = compare(results, baseline, options.tolerance)
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+    print(report)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(report + '\n')
+    if results.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,8 @@
 
 import unittest
 import client
+import async_client
+import asyncio
 import constants
 import select
 import time
@@ -15,11 +17,26 @@ import os
 import os.path
 import logging
 import sys
+import subprocess
+import threading
+import block_hashes
 
 DATADIR = 'testdata'
 TIMEOUT = 3  # Una cantidad razonable de segundos para esperar respuestas
 
 
+def run_async(coroutine):
+    """
+    Corre `coroutine` en un loop nuevo y devuelve su resultado (como
+    `asyncio.run`, que no está en Python 3.6).
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
 class TestBase(unittest.TestCase):
 
     # Entorno de testing ...
@@ -101,6 +118,48 @@ class TestHFTPServer(TestBase):
         self.assertEqual(files, ['bar', 'foo', 'x'])
         c.close()
 
+    def test_lookup_pages(self):
+        correct_list = []
+        for i in range(25):
+            filename = 'file%02d' % i
+            open(os.path.join(DATADIR, filename), 'w').close()
+            correct_list.append(filename)
+        c = self.new_client()
+        pages = list(c.file_lookup_pages(10))
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), correct_list,
+                         "El listado paginado no es el correcto")
+        # Pedir con el cursor final no vuelve a empezar.
+        self.assertEqual(c.file_lookup(10, constants.LISTING_END), [])
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(c.cursor, constants.LISTING_END)
+        # Si el directorio cambia entre páginas, las siguientes lo ven.
+        time.sleep(0.2)
+        self.assertEqual(c.file_lookup(10), correct_list[:10])
+        open(os.path.join(DATADIR, 'file10b'), 'w').close()
+        self.assertEqual(c.file_lookup(10, c.cursor)[:2],
+                         ['file10', 'file10b'])
+        # Si la última página se llena justo, no sigue una página vacía.
+        os.remove(os.path.join(DATADIR, 'file10b'))
+        for filename in correct_list[20:]:
+            os.remove(os.path.join(DATADIR, filename))
+        self.assertEqual([len(page) for page in c.file_lookup_pages(10)],
+                         [10, 10])
+        c.close()
+
+    def test_lookup_unsendable_names(self):
+        for name in ('bar', 'foo', 'ñandú.txt', 'dos\r\nlineas'):
+            open(os.path.join(DATADIR, name), 'w').close()
+        c = self.new_client()
+        # Los nombres que no se pueden enviar se omiten, en vez de cortar
+        # la respuesta.
+        self.assertEqual(sorted(c.file_lookup()), ['bar', 'foo'])
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(sum(c.file_lookup_pages(10), []), ['bar', 'foo'])
+        self.assertEqual(c.status, constants.CODE_OK)
+        c.close()
+
     def test_get_metadata(self):
         test_size = 123459
         f = open(os.path.join(DATADIR, 'bar'), 'w')
@@ -171,6 +230,263 @@ class TestHFTPServer(TestBase):
         f.close()
         c.close()
 
+    def test_get_slice_raw(self):
+        self.output_file = 'bar'
+        test_data = bytes(range(256)) * 4 + b'\r\n' * 100
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        c.get_slice_raw(self.output_file, 10, 1000)
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file, 'rb')
+        self.assertEqual(f.read(), test_data[10:1010],
+                         "El contenido del archivo no es el correcto")
+        f.close()
+        # La conexión sigue sirviendo para otros comandos.
+        m = c.get_metadata(self.output_file)
+        self.assertEqual(m, len(test_data))
+        c.close()
+
+    def test_retrieve_segmented(self):
+        self.output_file = 'bar'
+        test_data = ''.join(chr(ord('a') + i % 26) for i in range(1000))
+        f = open(os.path.join(DATADIR, self.output_file), 'w')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        c.retrieve(self.output_file, connections=3, segment_size=128)
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file)
+        self.assertEqual(f.read(), test_data,
+                         "El contenido del archivo bajado por segmentos no "
+                         "es el correcto")
+        f.close()
+        c.close()
+
+    def test_retrieve_resume(self):
+        self.output_file = 'bar'
+        test_data = 'x' * 500 + 'y' * 500
+        f = open(os.path.join(DATADIR, self.output_file), 'w')
+        f.write(test_data)
+        f.close()
+        # Una descarga anterior dejó bajados los primeros 500 bytes. Ponemos
+        # otro contenido para verificar que no se vuelven a pedir.
+        f = open(self.output_file, 'w')
+        f.write('z' * 500)
+        f.close()
+        f = open(self.output_file + client.JOURNAL_SUFFIX, 'w')
+        f.write('1000\n0 500\n')
+        f.close()
+        c = self.new_client()
+        c.retrieve(self.output_file, segment_size=128, resume=True)
+        self.assertEqual(c.status, constants.CODE_OK)
+        f = open(self.output_file)
+        self.assertEqual(f.read(), 'z' * 500 + 'y' * 500,
+                         "La descarga retomada no es la correcta")
+        f.close()
+        self.assertFalse(
+            os.path.exists(self.output_file + client.JOURNAL_SUFFIX),
+            "No se borró el journal al terminar la descarga")
+        c.close()
+
+    def test_sync(self):
+        self.output_file = 'bar'
+        block = 1024
+        test_data = 'a' * block + 'b' * block + 'c' * block + 'd' * 100
+        f = open(os.path.join(DATADIR, self.output_file), 'w')
+        f.write(test_data)
+        f.close()
+        # Copia local con el segundo bloque distinto y sin el final.
+        f = open(self.output_file, 'w')
+        f.write('a' * block + 'x' * block + 'c' * block)
+        f.close()
+        c = self.new_client()
+        fetched = c.sync(self.output_file, block)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(fetched, block + 100,
+                         "Se bajaron bloques que no habían cambiado")
+        f = open(self.output_file)
+        self.assertEqual(f.read(), test_data,
+                         "El contenido del archivo sincronizado no es el "
+                         "correcto")
+        f.close()
+        c.close()
+
+    def test_block_hashes(self):
+        test_data = os.urandom(3 * 2 ** 20 + 100)
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(test_data)
+        f.close()
+        # Archivo disperso con más de MAX_HASH_BLOCKS bloques de 1024.
+        f = open(os.path.join(DATADIR, 'big'), 'wb')
+        f.truncate(constants.MAX_HASH_BLOCKS * 1024 + 1)
+        f.close()
+        c = self.new_client()
+        # Varios pedazos de la respuesta, enviados a medida que se calculan.
+        for _ in range(2):
+            hashes = c.get_block_hashes('bar', 1024)
+            self.assertEqual(c.status, constants.CODE_OK)
+            self.assertEqual(
+                hashes,
+                [block_hashes.block_digest(test_data[i:i + 1024])
+                 for i in range(0, len(test_data), 1024)],
+                "Los hashes por bloque no son los correctos")
+        self.assertEqual(c.get_block_hashes('big', 1024), None)
+        self.assertEqual(c.status, constants.INVALID_ARGUMENTS)
+        c.close()
+
+    def test_compressed_slices(self):
+        self.output_file = 'bar'
+        text = ('The quick brown fox jumped over the lazy dog\n' * 2000)
+        noise = os.urandom(20000)
+        test_data = text.encode("ascii") + noise
+        f = open(os.path.join(DATADIR, self.output_file), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        c.set_compression(6)
+        self.assertEqual(c.status, constants.CODE_OK)
+        # Un slice compresible, uno que no lo es y uno muy chico.
+        for start, length in [(0, len(text)), (len(text), len(noise)),
+                              (10, 20)]:
+            c.get_slice(self.output_file, start, length)
+            self.assertEqual(c.status, constants.CODE_OK)
+            f = open(self.output_file, 'rb')
+            self.assertEqual(f.read(), test_data[start:start + length],
+                             "El contenido del slice comprimido no es el "
+                             "correcto")
+            f.close()
+        c.close()
+
+    def test_get_slices(self):
+        test_data = ''.join(chr(ord('a') + i % 26) for i in range(1000))
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write(test_data)
+        f.close()
+        # Rangos desordenados, superpuestos, contiguos y vacíos.
+        ranges = [(500, 100), (0, 10), (550, 100), (10, 5), (999, 1),
+                  (300, 0)]
+        c = self.new_client()
+        fragments = c.get_slices('bar', ranges)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(
+            fragments,
+            [test_data[start:start + length].encode("ascii")
+             for start, length in ranges],
+            "Los fragmentos del pedido múltiple no son los correctos")
+        c.close()
+
+    def test_get_slices_large(self):
+        test_data = os.urandom(2 ** 20)
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(test_data)
+        f.close()
+        # Rangos de más de un pedazo codificado, separados por huecos chicos
+        # y grandes.
+        ranges = [(0, 300000), (310000, 5), (700000, 300000), (400000, 1)]
+        c = self.new_client()
+        fragments = c.get_slices('bar', ranges)
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertEqual(fragments, [test_data[start:start + length]
+                                     for start, length in ranges])
+        # El mismo rango repetido cuenta por cada vez que se pide.
+        fragments = c.get_slices('bar', [(0, 2 ** 20)] * 100)
+        self.assertEqual(c.status, constants.INVALID_ARGUMENTS)
+        c.close()
+
+    def test_client_pipeline(self):
+        names = ['file%d' % i for i in range(50)]
+        for i, name in enumerate(names):
+            f = open(os.path.join(DATADIR, name), 'w')
+            f.write('x' * i)
+            f.close()
+        c = self.new_client()
+        # Pocos comandos en vuelo, para que el pipeline tenga que esperar.
+        pipeline = c.pipeline(max_in_flight=4)
+        sizes = [pipeline.get_metadata(name) for name in names]
+        missing = pipeline.get_metadata('nonexistent')
+        piece = pipeline.get_slice('file10', 2, 5)
+        listing = pipeline.file_lookup()
+        self.assertEqual(sorted(listing.result()),
+                         sorted(os.listdir(DATADIR)))
+        results = list(pipeline)
+        self.assertEqual(len(results), len(names) + 3)
+        self.assertEqual([r.value for r in sizes], list(range(len(names))),
+                         "Los tamaños del pipeline no son los correctos")
+        self.assertEqual(missing.status, constants.FILE_NOT_FOUND)
+        self.assertEqual(missing.value, None)
+        self.assertEqual(piece.value, b'xxxxx')
+        # La conexión sigue sincronizada luego del pipeline.
+        self.assertEqual(c.get_metadata('file3'), 3)
+        c.close()
+
+    def test_async_client(self):
+        test_data = os.urandom(200000)
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(test_data)
+        f.close()
+        self.output_file = 'bar'
+
+        async def run():
+            pool = async_client.ConnectionPool(max_connections=4)
+            c = async_client.AsyncClient(pool=pool, timeout=TIMEOUT)
+            key = (c.host, c.port)
+            sizes = await asyncio.gather(
+                *(c.get_metadata('bar') for _ in range(20)))
+            missing = await c.get_metadata('nonexistent')
+            piece = await c.get_slice('bar', 1000, 500)
+            done = await c.retrieve('bar', connections=4, segment_size=30000)
+            # Nunca más de 4 conexiones, y se reusan entre pedidos.
+            opened = pool.opened[key]
+            await c.close()
+            return sizes, missing, piece, done, opened
+
+        sizes, missing, piece, done, opened = run_async(run())
+        self.assertEqual(sizes, [len(test_data)] * 20)
+        self.assertEqual(missing, None)
+        self.assertEqual(piece, test_data[1000:1500])
+        self.assertTrue(done)
+        self.assertEqual(open('bar', 'rb').read(), test_data,
+                         "El archivo bajado por el cliente asyncio no es "
+                         "correcto")
+        self.assertTrue(0 < opened <= 4)
+
+    def test_sequential_slices(self):
+        test_data = os.urandom(2000000)
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(test_data)
+        f.close()
+        c = self.new_client()
+        before = c.get_stats().get('readahead_bytes', 0)
+        # Recorremos el archivo en orden: el server puede leer por
+        # adelantado lo que sigue, sin cambiar las respuestas.
+        pieces = [c.pipeline(1).get_slice('bar', offset, 100000).result()
+                  for offset in range(0, len(test_data), 100000)]
+        self.assertEqual(b''.join(pieces), test_data,
+                         "Los slices recorridos en orden no son correctos")
+        self.assertTrue(c.get_stats()['readahead_bytes'] > before)
+        c.close()
+
+    def test_get_stats(self):
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('x' * 100)
+        f.close()
+        c = self.new_client()
+        c.get_metadata('bar')
+        c.get_metadata('nonexistent')
+        c.get_slice_raw('bar', 0, 100)
+        self.output_file = 'bar'
+        stats = c.get_stats()
+        self.assertEqual(c.status, constants.CODE_OK)
+        self.assertTrue(stats['connections_active'] >= 1)
+        self.assertTrue(stats['command_get_metadata_count'] >= 2)
+        self.assertTrue(stats['command_get_slice_raw_count'] >= 1)
+        self.assertTrue(stats['status_%d' % constants.FILE_NOT_FOUND] >= 1)
+        self.assertTrue(stats['disk_bytes_read'] >= 100)
+        self.assertTrue(stats['bytes_sent'] >= 100)
+        c.close()
+
 
 class TestHFTPErrors(TestBase):
 
@@ -219,6 +535,30 @@ class TestHFTPErrors(TestBase):
                          "mal tipada (status=%d)" % status)
         c.close()
 
+    def test_bad_offset_raw(self):
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('data')
+        f.close()
+        c = self.new_client()
+        c.send('get_slice_raw bar 2 3')
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.BAD_OFFSET,
+                         "El servidor no contestó 203 ante un slice que excede "
+                         "el archivo")
+        c.close()
+
+    def test_bad_offset_batch(self):
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('data')
+        f.close()
+        c = self.new_client()
+        c.send('get_slices bar 0:2,2:3')
+        status, message = c.read_response_line(TIMEOUT)
+        self.assertEqual(status, constants.BAD_OFFSET,
+                         "El servidor no contestó 203 ante un rango que "
+                         "excede el archivo")
+        c.close()
+
     def test_file_not_found(self):
         c = self.new_client()
         c.send('get_metadata does_not_exist')
@@ -252,6 +592,23 @@ class TestHFTPHard(TestBase):
         c.connected = False
         c.s.close()
 
+    def test_pipelined_commands(self):
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('data')
+        f.close()
+        c = self.new_client()
+        # El segundo comando llega partido entre dos envíos.
+        c.s.send('get_metadata bar\r\nget_meta'.encode("ascii"))
+        time.sleep(0.5)
+        c.s.send('data bar\r\n'.encode("ascii"))
+        for _ in range(2):
+            status, message = c.read_response_line(TIMEOUT)
+            self.assertEqual(status, constants.CODE_OK,
+                             "El servidor no entendio comandos enviados "
+                             "sin esperar las respuestas")
+            self.assertEqual(c.read_line(TIMEOUT), '4')
+        c.close()
+
     def test_big_filename(self):
         c = self.new_client()
         c.send('get_metadata ' + 'x' * (5 * 2 ** 20), timeout=120)
@@ -293,11 +650,218 @@ class TestHFTPHard(TestBase):
         c.close()
 
 
+class TestHFTPOptions(TestBase):
+    """
+    Tests que levantan su propio server, con opciones distintas de las del
+    server contra el que se corren los demás.
+    """
+
+    def start_server(self, *options):
+        """
+        Corre `server.py` con `options` en un puerto libre, sirviendo
+        `DATADIR`. Devuelve el puerto; el server se termina al final del
+        test.
+        """
+        process = subprocess.Popen(
+            [sys.executable, '-u', 'server.py', '-p', '0', '-d', DATADIR,
+             '-l', ''] + list(options),
+            stdout=subprocess.PIPE, universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.addCleanup(process.wait)
+        self.addCleanup(process.terminate)
+        # Primera línea: Serving DIRECTORIO on DIRECCION:PUERTO.
+        line = process.stdout.readline()
+        self.assertTrue(line.startswith('Serving'),
+                        "El server no arrancó: %r" % line)
+        return int(line.rstrip().rstrip('.').rsplit(':', 1)[1])
+
+    def test_server_busy(self):
+        port = self.start_server('-w', '2', '-q', '1')
+        # Dos conexiones ocupan los workers y una espera en la cola.
+        clients = [client.Client(constants.DEFAULT_ADDR, port)
+                   for _ in range(3)]
+        for c in clients[:2]:
+            self.assertEqual(c.get_metadata('nonexistent'), None)
+            self.assertEqual(c.status, constants.FILE_NOT_FOUND)
+        # La siguiente no entra y se rechaza enseguida.
+        s = socket.create_connection((constants.DEFAULT_ADDR, port))
+        s.settimeout(TIMEOUT)
+        self.assertEqual(s.recv(1024).split()[0],
+                         str(constants.SERVER_BUSY).encode("ascii"))
+        s.close()
+        # Al irse un cliente, la conexión en la cola pasa a un worker y
+        # vuelve a haber lugar.
+        clients[0].close()
+        clients[2].get_metadata('nonexistent')
+        self.assertEqual(clients[2].status, constants.FILE_NOT_FOUND)
+        for c in clients[1:]:
+            c.close()
+        c = client.Client(constants.DEFAULT_ADDR, port)
+        c.close()
+        self.assertEqual(c.status, constants.CODE_OK)
+
+    def test_slow_command(self):
+        for mode in ('threads', 'events'):
+            port = self.start_server('-m', mode, '--read-timeout', '1')
+            s = socket.create_connection((constants.DEFAULT_ADDR, port))
+            s.settimeout(TIMEOUT)
+            # Mandando un byte por vez el plazo no se alarga: el comando
+            # tiene que llegar completo dentro del plazo de lectura.
+            start = time.monotonic()
+            try:
+                for byte in b'get_metadata ' + b'x' * 100:
+                    s.send(bytes([byte]))
+                    time.sleep(0.25)
+                    if time.monotonic() - start > 4:
+                        break
+                closed = not s.recv(1024)
+            except ConnectionError:
+                closed = True
+            except socket.timeout:
+                closed = False
+            s.close()
+            self.assertTrue(closed and time.monotonic() - start < 4,
+                            "No se cortó una conexión que envía el comando "
+                            "de a un byte (modo %s)" % mode)
+
+    def test_partial_command_idle(self):
+        for mode in ('threads', 'events'):
+            port = self.start_server('-m', mode, '--read-timeout', '0',
+                                     '--idle-timeout', '1')
+            s = socket.create_connection((constants.DEFAULT_ADDR, port))
+            s.settimeout(TIMEOUT)
+            # Sin plazo de lectura, un comando a medias se corta por el de
+            # inactividad.
+            start = time.monotonic()
+            s.send(b'get_meta')
+            try:
+                closed = not s.recv(1024)
+            except ConnectionError:
+                closed = True
+            except socket.timeout:
+                closed = False
+            s.close()
+            self.assertTrue(closed and time.monotonic() - start < TIMEOUT,
+                            "No se cortó una conexión inactiva con un "
+                            "comando a medias (modo %s)" % mode)
+
+    def test_slice_cache(self):
+        port = self.start_server('--slice-cache', '1000000')
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('a' * 1000)
+        f.close()
+        c = client.Client(constants.DEFAULT_ADDR, port)
+        for _ in range(2):
+            piece = c.pipeline(1).get_slice('bar', 10, 100).result()
+            self.assertEqual(piece, b'a' * 100)
+        stats = c.get_stats()
+        self.assertEqual(stats['slice_cache_misses'], 1)
+        self.assertEqual(stats['slice_cache_hits'], 1)
+        self.assertEqual(stats['slice_cache_entries'], 1)
+        # Al cambiar el archivo se descartan sus respuestas cacheadas.
+        f = open(os.path.join(DATADIR, 'bar'), 'w')
+        f.write('b' * 2000)
+        f.close()
+        deadline = time.monotonic() + TIMEOUT
+        while (c.get_stats()['slice_cache_entries'] > 0
+               and time.monotonic() < deadline):
+            time.sleep(0.05)
+        self.assertEqual(c.get_stats()['slice_cache_entries'], 0)
+        piece = c.pipeline(1).get_slice('bar', 10, 100).result()
+        self.assertEqual(piece, b'b' * 100,
+                         "Se envió una respuesta cacheada de un archivo que "
+                         "cambió")
+        c.close()
+
+    def test_concurrent_slices(self):
+        test_data = os.urandom(2 ** 20)
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(test_data)
+        f.close()
+        port = self.start_server('-m', 'threads', '--slice-cache', '0')
+        clients = [client.Client(constants.DEFAULT_ADDR, port)
+                   for _ in range(16)]
+        # Muchos pedidos iguales a la vez: el server lee y codifica el
+        # slice una sola vez para los que llegan mientras lo arma, y todos
+        # reciben la respuesta completa. Repetimos por si no coinciden.
+        for _ in range(5):
+            pipelines = [c.pipeline(1) for c in clients]
+            pieces = [p.get_slice('bar', 0, 2 ** 20) for p in pipelines]
+            for p in pipelines:
+                p.flush()
+            self.assertEqual([piece.result() for piece in pieces],
+                             [test_data] * 16,
+                             "Los slices pedidos a la vez no son los "
+                             "correctos")
+            stats = clients[0].get_stats()
+            if stats['slices_shared'] > 0:
+                break
+        self.assertGreater(stats['slices_shared'], 0,
+                           "Los pedidos simultáneos no compartieron la "
+                           "lectura del slice")
+        self.assertLess(stats['disk_bytes_read'], 5 * 16 * 2 ** 20)
+        for c in clients:
+            c.close()
+
+    def test_rate_limit(self):
+        self.output_file = 'bar'
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(os.urandom(3000000))
+        f.close()
+        for options in (('-m', 'threads', '--connection-rate-limit', '1000000'),
+                        ('-m', 'events', '--ip-rate-limit', '1000000')):
+            port = self.start_server(*options)
+            bulk = client.Client(constants.DEFAULT_ADDR, port)
+            other = client.Client(constants.DEFAULT_ADDR, port)
+            start = time.monotonic()
+            transfer = threading.Thread(
+                target=bulk.get_slice_raw, args=('bar', 0, 3000000))
+            transfer.start()
+            # Mientras tanto, las respuestas chicas no esperan atrás de la
+            # transferencia.
+            time.sleep(0.5)
+            for _ in range(5):
+                before = time.monotonic()
+                self.assertEqual(other.get_metadata('bar'), 3000000)
+                self.assertLess(time.monotonic() - before, 0.2,
+                                "get_metadata demorado con %s" % (options,))
+            transfer.join()
+            elapsed = time.monotonic() - start
+            self.assertEqual(bulk.status, constants.CODE_OK)
+            self.assertEqual(os.path.getsize('bar'), 3000000)
+            # 3 MB a 1 MB/s, con el primer segundo de ráfaga.
+            self.assertTrue(1.5 < elapsed < 3,
+                            "Transferencia de %.2f segundos con %s"
+                            % (elapsed, options))
+            bulk.close()
+            other.close()
+
+    def test_slice_latency(self):
+        f = open(os.path.join(DATADIR, 'bar'), 'wb')
+        f.write(os.urandom(2 ** 20))
+        f.close()
+        for options in (('-m', 'events'), ('--shared-slice-size', '0')):
+            port = self.start_server(*options)
+            c = client.Client(constants.DEFAULT_ADDR, port)
+            # Una respuesta partida en escrituras chicas se demora unos
+            # 40 ms esperando el ACK demorado del cliente.
+            stalls = 0
+            for i in range(200):
+                start = time.monotonic()
+                c.pipeline(1).get_slice('bar', (i % 16) * 2 ** 16,
+                                        2 ** 16).result()
+                if time.monotonic() - start > 0.03:
+                    stalls += 1
+            c.close()
+            self.assertLess(stalls, 4, "Slices demorados con %s" % (options,))
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestHFTPServer))
     suite.addTest(unittest.makeSuite(TestHFTPErrors))
     suite.addTest(unittest.makeSuite(TestHFTPHard))
+    suite.addTest(unittest.makeSuite(TestHFTPOptions))
     return suite
 
 
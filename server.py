@@ -8,11 +8,50 @@
 
 import os
 import sys
+import time
+import signal
 import socket
+import queue
+import heapq
+import itertools
+import traceback
 import optparse
+import resource
+import selectors
 import threading
 import connection as c
 from constants import *
+from stat_cache import StatCache
+from slice_cache import SliceCache
+from listing import ListingSnapshot
+from fd_pool import FilePool
+from block_hashes import HashCache
+from metrics import Metrics, serve_prometheus
+from access_log import AccessLog
+from rate_limit import RateLimiter
+from singleflight import SingleFlight
+from readahead import ReadAhead
+
+# Señales que el supervisor reenvía a los procesos para terminarlos.
+FORWARDED_SIGNALS = {signal.SIGINT, signal.SIGTERM, signal.SIGHUP}
+
+
+def bind_socket(addr, port, reuse_port=False):
+    """
+    Crea un socket IPv4 TCP asociado a la dirección y puerto especificados.
+    Con `reuse_port`, varios procesos pueden asociar un socket al mismo
+    puerto y el kernel reparte las conexiones entre ellos.
+    """
+    # 2. Creamos socket IPv4 TCP
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Permitimos reiniciar el server enseguida, aunque queden conexiones
+    # viejas en TIME_WAIT.
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # 3. Asociamos el socket a la dirección y puerto especificado
+    s.bind((addr, port))
+    return s
 
 
 class Server(object):
@@ -21,10 +60,29 @@ class Server(object):
     especificados donde se reciben nuevas conexiones de clientes.
     """
 
-    def __init__(self, addr=DEFAULT_ADDR, port=DEFAULT_PORT,
-                 directory=DEFAULT_DIR):
+    # Si las conexiones pueden atenderse a la vez y conviene combinar sus
+    # lecturas de get_slice iguales.
+    concurrent = True
 
-        sys.stdout.write("Serving %s on %s:%s.\n" % (directory, addr, port))
+    def __init__(self, addr=DEFAULT_ADDR, port=DEFAULT_PORT,
+                 directory=DEFAULT_DIR, workers=DEFAULT_WORKERS,
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 stat_cache_size=DEFAULT_STAT_CACHE_SIZE,
+                 slice_cache_size=DEFAULT_SLICE_CACHE_SIZE,
+                 shared_slice_size=DEFAULT_SHARED_SLICE_SIZE,
+                 readahead_budget=DEFAULT_READAHEAD_BUDGET,
+                 fd_pool_size=DEFAULT_FD_POOL_SIZE,
+                 hash_cache_size=DEFAULT_HASH_CACHE_SIZE, hash_index=None,
+                 metrics_port=None, access_log=None,
+                 log_sample=DEFAULT_LOG_SAMPLE,
+                 log_queue_size=DEFAULT_LOG_QUEUE_SIZE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 write_timeout=DEFAULT_WRITE_TIMEOUT,
+                 rate_limit=DEFAULT_RATE_LIMIT,
+                 ip_rate_limit=DEFAULT_IP_RATE_LIMIT,
+                 connection_rate_limit=DEFAULT_CONNECTION_RATE_LIMIT,
+                 reuse_port=False, listener=None):
 
         # 0. Revisamos si existe el directorio sino lo creamos.
         if not os.path.isdir(directory):
@@ -34,39 +92,182 @@ class Server(object):
         self.addr = addr
         self.port = port
         self.directory = directory
+        self.workers = workers
+        self.queue_size = queue_size
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        # Recursos compartidos por todas las conexiones.
+        self.stat_cache = None
+        if stat_cache_size > 0:
+            self.stat_cache = StatCache(stat_cache_size, directory)
+        self.slice_cache = None
+        if slice_cache_size > 0:
+            self.slice_cache = SliceCache(slice_cache_size)
+            if self.stat_cache is not None:
+                self.stat_cache.add_listener(self.slice_cache.invalidate)
+        self.slice_flights = None
+        self.shared_slice_size = shared_slice_size
+        if self.concurrent and shared_slice_size > 0:
+            self.slice_flights = SingleFlight()
+        self.readahead = None
+        if readahead_budget > 0:
+            self.readahead = ReadAhead(readahead_budget)
+        self.fd_pool = None
+        if fd_pool_size > 0:
+            self.fd_pool = FilePool(fd_pool_size)
+            if self.stat_cache is not None:
+                self.stat_cache.add_listener(self.fd_pool.invalidate)
+        self.listing = ListingSnapshot(directory)
+        self.hash_cache = None
+        if hash_cache_size > 0:
+            self.hash_cache = HashCache(hash_cache_size, hash_index)
+            if self.stat_cache is not None:
+                self.stat_cache.add_listener(self.hash_cache.invalidate)
+        self.metrics = Metrics()
+        if self.slice_cache is not None:
+            self.metrics.add_source('slice_cache', self.slice_cache.stats)
+        if metrics_port is not None:
+            # Solo en localhost: las métricas no son para los clientes.
+            serve_prometheus(self.metrics, metrics_port)
+        # `access_log` es un archivo abierto donde registrar los pedidos.
+        self.access_log = None
+        if access_log is not None and log_sample > 0:
+            self.access_log = AccessLog(access_log, log_sample,
+                                        log_queue_size)
+            self.metrics.add_source(
+                'access_log', lambda: {'dropped': self.access_log.dropped})
+        self.rate_limiter = None
+        if rate_limit or ip_rate_limit or connection_rate_limit:
+            self.rate_limiter = RateLimiter(rate_limit, ip_rate_limit,
+                                            connection_rate_limit)
 
-        # 2. Creamos socket IPv4 TCP
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # 3. Asociamos el socket a la dirección y puerto especificado
-        self.s.bind((addr, port))
+        if listener is not None:
+            # Socket ya escuchando, heredado del proceso supervisor.
+            self.s = listener
+            self.port = self.s.getsockname()[1]
+        else:
+            self.s = bind_socket(addr, port, reuse_port)
+            # Con el puerto 0 el sistema elige uno libre: anotamos cuál.
+            self.port = self.s.getsockname()[1]
+            # 4. Ponemos al socket en modo servidor escuchando conexiones
+            # entrantes.
+            self.s.listen()
+        sys.stdout.write("Serving %s on %s:%s.\n"
+                         % (directory, addr, self.port))
 
-        # 4. Ponemos al socket en modo servidor escuchando conexiones entrantes.
-        self.s.listen()
+    def _new_connection(self, connection_class, client_connection):
+        """
+        Crea el objeto que atiende una conexión, dándole acceso a los
+        recursos compartidos del servidor.
+        """
+        # Las respuestas ya se arman en pocas escrituras grandes: que el
+        # kernel no demore las chicas (la línea de estado de
+        # get_slice_raw, o las respuestas de pedidos encadenados) esperando
+        # el ACK del cliente.
+        client_connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        throttle = None
+        if self.rate_limiter is not None:
+            try:
+                ip = client_connection.getpeername()[0]
+            except OSError:
+                ip = None
+            throttle = self.rate_limiter.throttle(ip)
+        return connection_class(client_connection, self.directory,
+                                stat_cache=self.stat_cache,
+                                slice_cache=self.slice_cache,
+                                slice_flights=self.slice_flights,
+                                shared_slice_size=self.shared_slice_size,
+                                readahead=self.readahead,
+                                listing=self.listing,
+                                fd_pool=self.fd_pool,
+                                hash_cache=self.hash_cache,
+                                metrics=self.metrics,
+                                access_log=self.access_log,
+                                idle_timeout=self.idle_timeout,
+                                read_timeout=self.read_timeout,
+                                write_timeout=self.write_timeout,
+                                throttle=throttle)
 
     def _hande_connection(self, client_connection):
         """
         Maneja una conexión entrante.
         """
         # Creamos un objeto Connection para manejar la conexión
-        connect = c.Connection(client_connection, self.directory)
+        connect = self._new_connection(c.Connection, client_connection)
         # Manejamos la conexión
         connect.handle()
 
+    def _worker(self):
+        """
+        Thread del pool: atiende una a una las conexiones de la cola.
+        """
+        while True:
+            client_connection = self.pending.get()
+            try:
+                self._hande_connection(client_connection)
+            except Exception as e:
+                # Un error en una conexión no debe matar al worker.
+                sys.stderr.write('Worker error: {}\n'.format(e))
+            finally:
+                self.slots.release()
+
+    def _reject(self, client_connection):
+        """
+        Rechaza una conexión porque el servidor está saturado, avisándole al
+        cliente con SERVER_BUSY sin bloquearse esperándolo.
+        """
+        message = '{} {} {}'.format(
+            SERVER_BUSY, error_messages[SERVER_BUSY], EOL)
+        try:
+            client_connection.setblocking(False)
+            client_connection.send(message.encode("ascii"))
+        except OSError:
+            pass
+        finally:
+            client_connection.close()
+
+    def _start_workers(self):
+        """
+        Crea la cola de conexiones pendientes y los threads del pool.
+        """
+        self.pending = queue.Queue()
+        # Lugares para conexiones: una por worker más las que esperan en la
+        # cola. Se libera recién cuando un worker termina la conexión, así
+        # se rechaza solo si de verdad todos están ocupados.
+        self.slots = threading.BoundedSemaphore(
+            self.workers + self.queue_size)
+        for _ in range(self.workers):
+            worker_thread = threading.Thread(target=self._worker, daemon=True)
+            worker_thread.start()
+
     def serve(self):
         """
-        Loop principal del servidor. Se acepta una conexión a la vez
-        y se espera a que concluya antes de seguir.
+        Loop principal del servidor. Acepta conexiones y las atiende en un
+        thread nuevo cada una o, si se configuró un pool de workers, las
+        encola para que las atienda el primer worker libre.
         """
+        if self.workers > 0:
+            self._start_workers()
 
         try:
             while True:
                 # Aceptamos una conexión entrante
                 client_connection, client_address = self.s.accept()
 
+                if self.workers > 0:
+                    # Si no hay lugar rechazamos enseguida, así los clientes
+                    # ya aceptados no esperan cada vez más.
+                    if self.slots.acquire(blocking=False):
+                        self.pending.put(client_connection)
+                    else:
+                        self._reject(client_connection)
+                    continue
+
                 # Creamos e iniciamos un thread para manejar la conexión.
                 cliente_thread = threading.Thread(
                     target=self._hande_connection, args=(client_connection,))
-                cliente_thread.start()                
+                cliente_thread.start()
         except ValueError as e:
             sys.stderr.write('{}\n'.format(e))
             sys.exit(1)
@@ -76,6 +277,286 @@ class Server(object):
             self.s.close()
 
 
+class EventServer(Server):
+    """
+    Servidor que atiende todas las conexiones desde un único loop de eventos
+    con sockets no bloqueantes, en lugar de crear un thread por conexión.
+    Cada conexión ociosa cuesta solo su socket y un objeto `EventConnection`.
+    """
+
+    # Los comandos se ejecutan de a uno en el loop: nunca hay dos lecturas
+    # en curso que combinar.
+    concurrent = False
+
+    def _raise_fd_limit(self):
+        """
+        Sube el límite de archivos abiertos al máximo permitido, ya que cada
+        conexión ocupa un descriptor.
+        """
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != hard:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            except (ValueError, OSError):
+                pass
+
+    def _accept(self):
+        """
+        Acepta todas las conexiones entrantes pendientes.
+        """
+        while True:
+            try:
+                client_connection, client_address = self.s.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except ValueError as e:
+                sys.stderr.write('{}\n'.format(e))
+                sys.exit(1)
+            except OSError as e:
+                # Por ejemplo, nos quedamos sin descriptores: reintentamos
+                # en la próxima vuelta del loop.
+                sys.stderr.write('accept: {}\n'.format(e))
+                return
+
+            connect = self._new_connection(
+                c.EventConnection, client_connection)
+            connect.events = selectors.EVENT_READ
+            self.selector.register(
+                client_connection, selectors.EVENT_READ, connect)
+
+    def _reap_expired(self):
+        """
+        Cierra las conexiones que no avanzaron dentro de su plazo.
+        """
+        now = time.monotonic()
+        for key in list(self.selector.get_map().values()):
+            connect = key.data
+            if connect is not None and connect.expired(now):
+                self.selector.unregister(connect.socket)
+                connect.close()
+                connect.metrics.add('connections_reaped')
+
+    def _dispatch(self, connect, mask):
+        """
+        Atiende los eventos de una conexión y actualiza lo que esperamos de
+        ella en el selector.
+        """
+        try:
+            if mask & selectors.EVENT_READ:
+                connect.on_readable()
+            # Intentamos enviar enseguida, sin esperar otra vuelta del loop.
+            if connect.wants_write():
+                connect.on_writable()
+        except Exception as e:
+            # Un error atendiendo a un cliente no debe tirar abajo el loop:
+            # cortamos solo esa conexión.
+            sys.stderr.write('Connection error: {}\n'.format(e))
+            connect._abort()
+
+        if connect.finished():
+            self.selector.unregister(connect.socket)
+            connect.close()
+            return
+
+        events = 0
+        if connect.wants_read():
+            events |= selectors.EVENT_READ
+        if connect.wants_write():
+            events |= selectors.EVENT_WRITE
+        if events != connect.events:
+            connect.events = events
+            self.selector.modify(connect.socket, events, connect)
+        if connect.output and connect.throttled():
+            # Frenada por los límites de ancho de banda: la despertamos
+            # cuando pueda seguir enviando.
+            heapq.heappush(self.throttled, (connect.throttled_until,
+                                            next(self.wakeups), connect))
+
+    def _wake_throttled(self):
+        """
+        Retoma el envío de las conexiones cuya espera por los límites de
+        ancho de banda ya terminó.
+        """
+        now = time.monotonic()
+        while self.throttled and self.throttled[0][0] <= now:
+            connect = heapq.heappop(self.throttled)[2]
+            # Puede haberse cerrado mientras esperaba.
+            if connect.socket.fileno() != -1:
+                self._dispatch(connect, 0)
+
+    def serve(self):
+        """
+        Loop principal del servidor. Espera eventos de todos los sockets a
+        la vez y atiende a cada conexión a medida que está lista.
+        """
+        self._raise_fd_limit()
+        self.s.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.s, selectors.EVENT_READ, None)
+        # Conexiones frenadas por los límites de ancho de banda, como
+        # (hasta cuándo, desempate, conexión).
+        self.throttled = []
+        self.wakeups = itertools.count()
+
+        next_sweep = time.monotonic() + TIMEOUT_SWEEP_INTERVAL
+        try:
+            while True:
+                timeout = TIMEOUT_SWEEP_INTERVAL
+                if self.throttled:
+                    timeout = min(timeout, max(
+                        self.throttled[0][0] - time.monotonic(), 0))
+                for key, mask in self.selector.select(timeout):
+                    if key.data is None:
+                        self._accept()
+                    else:
+                        self._dispatch(key.data, mask)
+                self._wake_throttled()
+                if time.monotonic() >= next_sweep:
+                    self._reap_expired()
+                    next_sweep = time.monotonic() + TIMEOUT_SWEEP_INTERVAL
+        finally:
+            sys.stdout.write(
+                'Closing server... \n')
+            for key in list(self.selector.get_map().values()):
+                if key.data is not None:
+                    key.data.close()
+            self.selector.close()
+            self.s.close()
+
+
+class Supervisor(object):
+    """
+    Modo prefork: atiende el puerto con `processes` procesos, cada uno con
+    su propio `server_class`, para usar varios núcleos a pesar del GIL.
+
+    Cada proceso asocia su propio socket al puerto con `SO_REUSEPORT`, y el
+    kernel reparte las conexiones entre ellos. Donde `SO_REUSEPORT` no
+    existe, todos heredan un único socket creado por el supervisor. Los
+    recursos compartidos (caches, pools, métricas, threads) se crean en cada
+    proceso luego del fork, así que no se comparten entre procesos. Si se
+    sirven métricas, el proceso `i` las sirve en `metrics_port + i`.
+
+    El supervisor reinicia los procesos que mueren y les reenvía SIGINT,
+    SIGTERM y SIGHUP para terminarlos.
+    """
+
+    def __init__(self, server_class, processes, addr=DEFAULT_ADDR,
+                 port=DEFAULT_PORT, **server_options):
+        self.server_class = server_class
+        self.processes = processes
+        self.addr = addr
+        self.server_options = server_options
+        # Proceso -> (número de proceso, momento en que se creó).
+        self.children = {}
+        self.stopping = False
+
+        self.listener = None
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        self.s = bind_socket(addr, port, self.reuse_port)
+        if not self.reuse_port:
+            self.s.listen()
+            self.listener = self.s
+        # Resolvemos el puerto 0 acá, así todos los procesos usan el mismo.
+        # Con SO_REUSEPORT este socket no escucha: solo reserva el puerto.
+        self.port = self.s.getsockname()[1]
+
+    def _spawn(self, index):
+        """
+        Crea el proceso número `index`.
+        """
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Bloqueamos las señales durante el fork: si no, una que llegue al
+        # hijo antes de restaurar sus handlers lo haría actuar de supervisor.
+        signal.pthread_sigmask(signal.SIG_BLOCK, FORWARDED_SIGNALS)
+        pid = os.fork()
+        if pid > 0:
+            self.children[pid] = (index, time.monotonic())
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, FORWARDED_SIGNALS)
+            return
+
+        # Proceso hijo: nunca vuelve al loop del supervisor.
+        status = 1
+        try:
+            for signum in (signal.SIGTERM, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, FORWARDED_SIGNALS)
+            if self.listener is None:
+                self.s.close()
+            options = dict(self.server_options)
+            if options.get('metrics_port') is not None:
+                options['metrics_port'] += index
+            server = self.server_class(
+                self.addr, self.port, reuse_port=self.reuse_port,
+                listener=self.listener, **options)
+            server.serve()
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except KeyboardInterrupt:
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _forward_signal(self, signum, frame):
+        """
+        Termina el supervisor, reenviándole la señal a los procesos.
+        """
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def serve(self):
+        """
+        Crea los procesos y los reinicia cuando mueren, hasta recibir una
+        señal de terminación.
+        """
+        for signum in FORWARDED_SIGNALS:
+            signal.signal(signum, self._forward_signal)
+        sys.stdout.write("Supervising %d processes on %s:%s.\n"
+                         % (self.processes, self.addr, self.port))
+        for index in range(self.processes):
+            if self.stopping:
+                break
+            self._spawn(index)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+            if os.WIFSIGNALED(status):
+                reason = "killed by signal %d" % os.WTERMSIG(status)
+            else:
+                reason = "exited with status %d" % os.WEXITSTATUS(status)
+            sys.stderr.write("Process %d (pid %d) %s, restarting.\n"
+                             % (index, pid, reason))
+            if time.monotonic() - started < MIN_PROCESS_LIFETIME:
+                time.sleep(MIN_PROCESS_LIFETIME)
+            if not self.stopping:
+                self._spawn(index)
+
+        sys.stdout.write('Closing server... \n')
+        self.s.close()
+
+
+SERVER_MODES = {
+    MODE_THREADS: Server,
+    MODE_EVENTS: EventServer,
+}
+
+
 def main():
     """Parsea los argumentos y lanza el server"""
 
@@ -89,6 +570,92 @@ def main():
     parser.add_option(
         "-d", "--datadir",
         help="Directorio compartido", default=DEFAULT_DIR)
+    parser.add_option(
+        "-m", "--mode", type="choice", choices=list(SERVER_MODES.keys()),
+        help="Modo de atención de conexiones: un thread por conexión "
+        "(threads) o un único loop de eventos (events)", default=DEFAULT_MODE)
+    parser.add_option(
+        "-w", "--workers", type="int",
+        help="Cantidad fija de threads que atienden conexiones en modo "
+        "threads (0: un thread por conexión)", default=DEFAULT_WORKERS)
+    parser.add_option(
+        "-n", "--processes", type="int",
+        help="Cantidad de procesos que atienden el puerto, para usar varios "
+        "núcleos (1: un solo proceso)", default=DEFAULT_PROCESSES)
+    parser.add_option(
+        "-q", "--queue-size", type="int",
+        help="Conexiones que pueden esperar a un worker libre antes de "
+        "rechazarlas con SERVER BUSY", default=DEFAULT_QUEUE_SIZE)
+    parser.add_option(
+        "--stat-cache", type="int",
+        help="Cantidad de archivos cuyos metadatos se cachean "
+        "(0: sin cache)", default=DEFAULT_STAT_CACHE_SIZE)
+    parser.add_option(
+        "--slice-cache", type="int",
+        help="Bytes de respuestas de get_slice que se cachean "
+        "(0: sin cache)", default=DEFAULT_SLICE_CACHE_SIZE)
+    parser.add_option(
+        "--shared-slice-size", type="int",
+        help="Bytes máximos de un get_slice cuya lectura se comparte entre "
+        "pedidos iguales simultáneos (0: no se comparte)",
+        default=DEFAULT_SHARED_SLICE_SIZE)
+    parser.add_option(
+        "--readahead-budget", type="int",
+        help="Bytes que se pueden pedir al disco por adelantado para los "
+        "clientes que leen archivos en orden (0: no leer por adelantado)",
+        default=DEFAULT_READAHEAD_BUDGET)
+    parser.add_option(
+        "--fd-pool", type="int",
+        help="Cantidad de archivos que se mantienen abiertos para leer "
+        "slices (0: sin pool)", default=DEFAULT_FD_POOL_SIZE)
+    parser.add_option(
+        "--hash-cache", type="int",
+        help="Cantidad de listas de hashes por bloque que se cachean "
+        "(0: sin cache)", default=DEFAULT_HASH_CACHE_SIZE)
+    parser.add_option(
+        "--hash-index",
+        help="Directorio donde guardar los hashes por bloque calculados, "
+        "para reusarlos al reiniciar (requiere --hash-cache)", default=None)
+    parser.add_option(
+        "--metrics-port", type="int",
+        help="Puerto local donde servir las métricas en formato Prometheus "
+        "(por defecto no se sirven)", default=None)
+    parser.add_option(
+        "--idle-timeout", type="float",
+        help="Segundos que una conexión puede estar sin enviar comandos "
+        "(0: sin límite)", default=DEFAULT_IDLE_TIMEOUT)
+    parser.add_option(
+        "--read-timeout", type="float",
+        help="Segundos que se espera el resto de un comando empezado sin "
+        "recibir datos (0: sin límite)", default=DEFAULT_READ_TIMEOUT)
+    parser.add_option(
+        "--write-timeout", type="float",
+        help="Segundos que se espera a que el cliente acepte datos de una "
+        "respuesta (0: sin límite)", default=DEFAULT_WRITE_TIMEOUT)
+    parser.add_option(
+        "--rate-limit", type="int",
+        help="Bytes por segundo que el servidor envía como máximo en total "
+        "(0: sin límite)", default=DEFAULT_RATE_LIMIT)
+    parser.add_option(
+        "--ip-rate-limit", type="int",
+        help="Bytes por segundo que se envían como máximo a cada IP de "
+        "cliente (0: sin límite)", default=DEFAULT_IP_RATE_LIMIT)
+    parser.add_option(
+        "--connection-rate-limit", type="int",
+        help="Bytes por segundo que se envían como máximo por cada conexión "
+        "(0: sin límite)", default=DEFAULT_CONNECTION_RATE_LIMIT)
+    parser.add_option(
+        "-l", "--access-log",
+        help="Archivo donde registrar los pedidos atendidos ('-': salida "
+        "estándar, '': no registrar)", default='-')
+    parser.add_option(
+        "--log-sample", type="float",
+        help="Fracción de los pedidos que se registran, entre 0 y 1",
+        default=DEFAULT_LOG_SAMPLE)
+    parser.add_option(
+        "--log-queue", type="int",
+        help="Entradas del registro que pueden esperar a escribirse antes "
+        "de descartarlas", default=DEFAULT_LOG_QUEUE_SIZE)
 
     options, args = parser.parse_args()
     if len(args) > 0:
@@ -102,7 +669,48 @@ def main():
         parser.print_help()
         sys.exit(1)
 
-    server = Server(options.address, port, options.datadir)
+    if (options.workers < 0 or options.queue_size < 1
+            or options.processes < 1
+            or options.stat_cache < 0 or options.slice_cache < 0
+            or options.shared_slice_size < 0 or options.readahead_budget < 0
+            or options.fd_pool < 0 or options.hash_cache < 0
+            or (options.metrics_port is not None
+                and not 0 < options.metrics_port < 65536)
+            or not 0 <= options.log_sample <= 1 or options.log_queue < 1
+            or options.idle_timeout < 0 or options.read_timeout < 0
+            or options.write_timeout < 0
+            or options.rate_limit < 0 or options.ip_rate_limit < 0
+            or options.connection_rate_limit < 0):
+        sys.stderr.write("Tamaño de pool, cola o cache invalido\n")
+        parser.print_help()
+        sys.exit(1)
+
+    access_log = None
+    if options.access_log == '-':
+        access_log = sys.stdout
+    elif options.access_log:
+        access_log = open(options.access_log, 'a')
+
+    server_class = SERVER_MODES[options.mode]
+    server_options = dict(
+        directory=options.datadir, workers=options.workers,
+        queue_size=options.queue_size, stat_cache_size=options.stat_cache,
+        slice_cache_size=options.slice_cache,
+        shared_slice_size=options.shared_slice_size,
+        readahead_budget=options.readahead_budget,
+        fd_pool_size=options.fd_pool,
+        hash_cache_size=options.hash_cache, hash_index=options.hash_index,
+        metrics_port=options.metrics_port, access_log=access_log,
+        log_sample=options.log_sample, log_queue_size=options.log_queue,
+        idle_timeout=options.idle_timeout, read_timeout=options.read_timeout,
+        write_timeout=options.write_timeout,
+        rate_limit=options.rate_limit, ip_rate_limit=options.ip_rate_limit,
+        connection_rate_limit=options.connection_rate_limit)
+    if options.processes > 1:
+        server = Supervisor(server_class, options.processes,
+                            options.address, port, **server_options)
+    else:
+        server = server_class(options.address, port, **server_options)
     server.serve()
 
 
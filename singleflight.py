@@ -0,0 +1,59 @@
+# encoding: utf-8
+# Combina pedidos simultáneos iguales para que el trabajo se haga una sola
+# vez, compartido por todas las conexiones del proceso.
+
+import threading
+
+
+class Call(object):
+    """
+    Un trabajo en curso y su resultado, que esperan los pedidos que llegan
+    mientras tanto.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Ejecuta una sola vez a la vez el trabajo de cada clave: si llega un
+    pedido con la misma clave que uno en curso, espera su resultado en lugar
+    de repetirlo.
+    """
+
+    def __init__(self):
+        # Clave -> `Call` en curso.
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function):
+        """
+        Devuelve un par `(resultado, compartido)`: el resultado de llamar a
+        `function()`, o el de la llamada en curso para `key` si la hay, y si
+        el resultado vino de esa otra llamada. Si `function` lanza una
+        excepción, la reciben todos los que la esperaban.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = function()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
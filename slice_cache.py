@@ -0,0 +1,96 @@
+# encoding: utf-8
+# Cache de respuestas de get_slice ya codificadas, compartido por todas las
+# conexiones del proceso.
+
+import threading
+from collections import OrderedDict
+
+
+class SliceCache(object):
+    """
+    Guarda respuestas de get_slice listas para enviar, indexadas por
+    `(file_info, offset, size)`, donde `file_info` es el `FileStat` del
+    archivo: si el archivo cambia, cambia la clave y la entrada vieja ya no
+    se usa.
+
+    Ocupa a lo sumo `max_bytes` bytes, descartando las respuestas usadas
+    hace más tiempo, y no guarda respuestas de slices de más de
+    `max_entry_size` bytes. Cuenta aciertos y fallos en `hits` y `misses`.
+    """
+
+    def __init__(self, max_bytes, max_entry_size=None):
+        self.max_bytes = max_bytes
+        if max_entry_size is None:
+            max_entry_size = max_bytes // 8
+        self.max_entry_size = max_entry_size
+        self.entries = OrderedDict()
+        # Ruta -> claves cacheadas de ese archivo, para invalidarlas juntas.
+        self.paths = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Devuelve la respuesta guardada para `key`, o `None`.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, path, key, message):
+        """
+        Guarda `message` como la respuesta para `key`, un slice de `path`.
+        """
+        if len(message) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (path, message)
+            self.paths.setdefault(path, set()).add(key)
+            self.size += len(message)
+            while self.size > self.max_bytes:
+                old_key, (old_path, old_message) = self.entries.popitem(
+                    last=False)
+                self._forget(old_path, old_key, old_message)
+
+    def invalidate(self, path):
+        """
+        Descarta las respuestas guardadas de `path`, o todas si es `None`.
+        Se registra como listener del `StatCache`.
+        """
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+                self.paths.clear()
+                self.size = 0
+                return
+            for key in list(self.paths.get(path, ())):
+                old_path, old_message = self.entries.pop(key)
+                self._forget(old_path, key, old_message)
+
+    def stats(self):
+        """
+        Devuelve un diccionario con el estado del cache.
+        """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _forget(self, path, key, message):
+        self.size -= len(message)
+        keys = self.paths[path]
+        keys.discard(key)
+        if not keys:
+            del self.paths[path]
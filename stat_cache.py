@@ -0,0 +1,323 @@
+# encoding: utf-8
+# Cache de metadatos de los archivos servidos, compartido por todas las
+# conexiones del proceso.
+
+import os
+import sys
+import stat
+import struct
+import ctypes
+import threading
+from collections import namedtuple, OrderedDict
+from constants import *
+
+# Lo que guardamos de cada archivo. La tupla completa identifica una
+# versión del archivo: si cambia cualquier campo, es otro contenido.
+FileStat = namedtuple('FileStat', ['size', 'mtime_ns', 'ino', 'dev'])
+
+# Eventos de inotify (ver `man 7 inotify`).
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_MOVE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def file_stat(path):
+    """
+    Consulta al sistema de archivos los metadatos de `path`.
+
+    Devuelve un `FileStat`, o `None` si no existe o no es un archivo regular.
+    """
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    return FileStat(st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev)
+
+
+class Inotify(object):
+    """
+    Avisa cuando cambia algún archivo de los directorios vigilados, usando
+    inotify de Linux a través de la libc.
+
+    Lanza `OSError` al crearse si inotify no está disponible.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+            self.add_watch.argtypes = [
+                ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            self.rm_watch = libc.inotify_rm_watch
+            self.rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except AttributeError:
+            raise OSError("inotify no disponible")
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+        self.fd = fd
+        self.lock = threading.Lock()
+        # Directorio vigilado -> watch descriptor, y al revés.
+        self.watches = {}
+        self.directories = {}
+
+        reader = threading.Thread(target=self._read_events, daemon=True)
+        reader.start()
+
+    def watch(self, directory):
+        """
+        Empieza a vigilar `directory`, si no se lo estaba vigilando ya.
+
+        Devuelve `False` si no se lo puede vigilar.
+        """
+        with self.lock:
+            if directory in self.watches:
+                return True
+            wd = self.add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                # Probablemente el directorio no existe: no cacheamos nada
+                # ahí, y se reintenta en la próxima consulta.
+                return False
+            self.watches[directory] = wd
+            self.directories[wd] = directory
+            return True
+
+    def unwatch(self, directory):
+        """
+        Deja de vigilar `directory`, si se lo estaba vigilando.
+        """
+        with self.lock:
+            wd = self.watches.pop(directory, None)
+            if wd is None:
+                return
+            del self.directories[wd]
+            self.rm_watch(self.fd, wd)
+
+    def _read_events(self):
+        """
+        Thread que lee los eventos de inotify e invalida el cache.
+        """
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except InterruptedError:
+                continue
+            except OSError as e:
+                sys.stderr.write('inotify: {}\n'.format(e))
+                return
+
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+                name = data[pos:pos + length].rstrip(b'\0')
+                pos += length
+                self._handle_event(wd, mask, os.fsdecode(name))
+
+    def _handle_event(self, wd, mask, name):
+        """
+        Invalida lo que corresponda según un evento de inotify.
+        """
+        if mask & IN_Q_OVERFLOW:
+            # Se perdieron eventos: no sabemos qué cambió.
+            self.cache.clear()
+            return
+
+        with self.lock:
+            directory = self.directories.get(wd)
+            if directory is not None and mask & IN_IGNORED:
+                # El directorio se borró o se movió: el kernel quitó la
+                # vigilancia. Se vuelve a agregar en la próxima consulta.
+                del self.directories[wd]
+                if self.watches.get(directory) == wd:
+                    del self.watches[directory]
+        if directory is None:
+            return
+
+        if name and not mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+            self.cache.invalidate(os.path.join(directory, name))
+        else:
+            self.cache.invalidate_directory(directory)
+
+
+class Poller(object):
+    """
+    Alternativa a `Inotify` donde no está disponible: cada `interval`
+    segundos vuelve a consultar los archivos cacheados e invalida los que
+    cambiaron de tamaño, fecha de modificación o inodo.
+    """
+
+    def __init__(self, cache, interval=STAT_POLL_INTERVAL):
+        self.cache = cache
+        self.interval = interval
+        self.stop = threading.Event()
+        poller = threading.Thread(target=self._poll, daemon=True)
+        poller.start()
+
+    def watch(self, directory):
+        return True
+
+    def unwatch(self, directory):
+        pass
+
+    def _poll(self):
+        while not self.stop.wait(self.interval):
+            for path, cached in self.cache.snapshot():
+                if file_stat(path) != cached:
+                    self.cache.invalidate(path)
+
+
+class StatCache(object):
+    """
+    Cache de `FileStat` por ruta, compartido por todas las conexiones.
+
+    Guarda a lo sumo `max_entries` rutas, descartando la usada hace más
+    tiempo. Las entradas se invalidan cuando el archivo cambia, avisado por
+    inotify o, si no está disponible, consultando periódicamente. Una
+    consulta que está en el cache no toca el sistema de archivos.
+
+    Si se da `root`, solo se cachean rutas dentro de ese directorio. Cada
+    directorio se vigila mientras tenga alguna ruta en el cache, así las
+    vigilancias de inotify no crecen más que el cache.
+    """
+
+    def __init__(self, max_entries=DEFAULT_STAT_CACHE_SIZE, root=None):
+        self.max_entries = max_entries
+        self.root = None
+        if root is not None:
+            self.root = os.path.join(os.path.abspath(root), '')
+        self.entries = OrderedDict()
+        # Directorio -> cantidad de rutas suyas en el cache.
+        self.directories = {}
+        self.lock = threading.Lock()
+        # Se incrementa con cada invalidación, para no guardar un resultado
+        # que pudo haber quedado viejo mientras se consultaba.
+        self.generation = 0
+        self.listeners = []
+        try:
+            self.watcher = Inotify(self)
+        except OSError:
+            self.watcher = Poller(self)
+
+    def add_listener(self, callback):
+        """
+        Registra `callback(path)`, que se llama cada vez que se invalida una
+        ruta. Con `path = None` se invalidó todo el cache.
+        """
+        self.listeners.append(callback)
+
+    def stat(self, path):
+        """
+        Devuelve el `FileStat` de `path`, o `None` si no es un archivo.
+        """
+        path = os.path.abspath(path)
+        if self.root is not None and not path.startswith(self.root):
+            # Fuera del directorio servido: no lo cacheamos ni vigilamos.
+            return file_stat(path)
+        with self.lock:
+            if path in self.entries:
+                self.entries.move_to_end(path)
+                return self.entries[path]
+            generation = self.generation
+
+        # Vigilamos el directorio antes de consultar, así no se nos escapa
+        # ningún cambio posterior a la consulta.
+        directory = os.path.dirname(path)
+        watched = self.watcher.watch(directory)
+        result = file_stat(path)
+
+        with self.lock:
+            if watched and generation == self.generation:
+                if path not in self.entries:
+                    self.directories[directory] = (
+                        self.directories.get(directory, 0) + 1)
+                self.entries[path] = result
+                self.entries.move_to_end(path)
+                while len(self.entries) > self.max_entries:
+                    old_path, _ = self.entries.popitem(last=False)
+                    self._forget(old_path)
+            elif watched and directory not in self.directories:
+                # No guardamos nada de este directorio: no hace falta
+                # vigilarlo.
+                self.generation += 1
+                self.watcher.unwatch(directory)
+        return result
+
+    def snapshot(self):
+        """
+        Devuelve una lista con los pares `(path, FileStat)` cacheados.
+        """
+        with self.lock:
+            return list(self.entries.items())
+
+    def invalidate(self, path):
+        """
+        Olvida lo que se sabe de `path`.
+        """
+        with self.lock:
+            self.generation += 1
+            if self.entries.pop(path, False) is not False:
+                self._forget(path)
+        self._notify(path)
+
+    def invalidate_directory(self, directory):
+        """
+        Olvida todas las rutas dentro de `directory`.
+        """
+        prefix = os.path.join(directory, '')
+        with self.lock:
+            self.generation += 1
+            paths = [path for path in self.entries if path.startswith(prefix)]
+            for path in paths:
+                del self.entries[path]
+                self._forget(path)
+        for path in paths:
+            self._notify(path)
+
+    def clear(self):
+        """
+        Olvida todo el contenido del cache.
+        """
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            for directory in self.directories:
+                self.watcher.unwatch(directory)
+            self.directories.clear()
+        self._notify(None)
+
+    def _forget(self, path):
+        """
+        Descuenta una ruta que salió del cache; si era la última de su
+        directorio, deja de vigilarlo. Se llama con el lock tomado.
+        """
+        directory = os.path.dirname(path)
+        self.directories[directory] -= 1
+        if self.directories[directory] == 0:
+            del self.directories[directory]
+            # Una consulta en curso pudo empezar a vigilarlo antes de que
+            # lo soltemos: que no guarde su resultado sin vigilancia.
+            self.generation += 1
+            self.watcher.unwatch(directory)
+
+    def _notify(self, path):
+        for callback in self.listeners:
+            callback(path)